@@ -1,13 +1,20 @@
 from dash import dcc, html, dash_table
 import dash_bootstrap_components as dbc
 import logging
+import pandas as pd
+import numpy as np
 
 import qplan_caller
 import qvis_plot
 import qvis_database
+import qvis_config as cfg
+import qvis_metrics as metrics
+from qvis_cache import LRUCache
 
 from argparse import ArgumentParser
 import os
+import time
+import diskcache
 from ginga.misc import log
 
 
@@ -30,32 +37,138 @@ def get_logger():
 
 logger = get_logger()
 
+# plotly figures by (query, display, groupby, selected programs, options)
+figure_cache = LRUCache(cfg.figure_cache_size)
 
-def create_call(grade, seeing, transp, filters, sdate, edate, maxOBquery, timewindow_obs):
+# background query jobs: Dash job results, and locks/results of the running queries
+job_cache = diskcache.Cache(cfg.job_cache_path)
+
+
+def create_call(grade, seeing, transp, filters, sdate, edate, maxOBquery, timewindow_obs, timings=None):
 
     logger.info("Creating the Call object")
-    call = qplan_caller.Call(grade, seeing, transp, filters, sdate, edate,
-                 maxOBquery, timewindow_obs,logger)
+    with metrics.span('call', timings):
+        call = qplan_caller.Call(grade, seeing, transp, filters, sdate, edate,
+                     maxOBquery, timewindow_obs,logger)
 
     return call
 
-def create_database(call):
+def create_database(call, progress=None, timings=None):
 
     logger.info("Creating the DataBase object")
-    db = qvis_database.DataBase(call,logger)
+    with metrics.span('database', timings):
+        db = qvis_database.DataBase(call,logger,progress)
+    metrics.count('visibility_windows', 'hit', db.windows_found)
+    metrics.count('visibility_windows', 'miss', db.windows_computed)
+    logger.info("Visibility windows: {} found in the database, {} computed".format(
+        db.windows_found, db.windows_computed))
     return db
 
 
-def make_plot_obj(df, sdate, edate, edate_user, db):
+def make_plot_obj(df, sdate, edate, edate_user, db, timings=None):
 
     logger.info("Creating the Plot object")
-    plot = qvis_plot.Plot(df, sdate, edate, edate_user, db)
+    with metrics.span('plot', timings):
+        plot = qvis_plot.Plot(df, sdate, edate, edate_user, db)
     return plot
 
 
-def make_fig(plot_obj, display, groupby, pgms, timewindow_obs, use_filter_schedule):
-
-    logger.info("Calling Plot functions in Plot object")
+def query_key(grade, seeing, transp, filters, sdate, edate, maxOBquery, timewindow_obs):
+    return repr((sorted(grade), sorted(seeing), sorted(transp), sorted(filters),
+                 sdate.isoformat(), edate.isoformat(), maxOBquery, timewindow_obs))
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def refine_query(state, grade, seeing, transp, filters, sdate, edate, maxOBquery, timewindow_obs):
+    """Session state of a query narrower than the session's previous one, or None.
+
+    The OBs and their visibility windows are filtered in memory (see
+    Call.subset and Plot.subset), without the queue database.
+    """
+    call = state['call'].subset(grade, seeing, transp, filters, sdate, edate,
+                                maxOBquery, timewindow_obs)
+    if call is None:
+        return None
+    logger.info("Refining the previous query")
+    timings = {}
+    with metrics.span('refine', timings):
+        plot_obj = state['plot_obj'].subset(call.df, call.sdate, call.edate, call.edate_user)
+    pgms = list(plot_obj.longdf.program.unique())
+    return {'call': call, 'plot_obj': plot_obj, 'pgms': pgms, 'pgm_select': pgms.copy(),
+            'timings': timings}
+
+
+def run_query(set_progress, grade, seeing, transp, filters, sdate, edate, maxOBquery, timewindow_obs,
+              previous=None):
+    """Query the OBs and build their visibility plot data, in a background job.
+
+    Reports its progress with set_progress((percent, label)) and returns the
+    session state {'call', 'plot_obj', 'pgms', 'pgm_select'}.  A query within
+    the session's 'previous' one is derived from it.  A query identical to one
+    already running is not computed again: the job waits for the other one
+    and takes its result.
+    """
+    if previous is not None:
+        state = refine_query(previous, grade, seeing, transp, filters, sdate, edate,
+                             maxOBquery, timewindow_obs)
+        if state is not None:
+            return state
+
+    key = query_key(grade, seeing, transp, filters, sdate, edate, maxOBquery, timewindow_obs)
+    lock = 'lock-'+key
+    while not job_cache.add(lock, os.getpid(), expire=cfg.job_timeout):
+        pid = job_cache.get(lock)
+        if pid is not None and not process_alive(pid):
+            job_cache.delete(lock)      # the job running it was cancelled
+            continue
+        set_progress((0, 'Waiting for the same query of another user'))
+        time.sleep(1)
+        if lock not in job_cache:
+            state = job_cache.get('result-'+key)
+            if state is not None:
+                return state
+
+    try:
+        set_progress((5, 'Querying OBs'))
+        timings = {}
+        call = create_call(grade, seeing, transp, filters, sdate, edate,
+                           maxOBquery=maxOBquery, timewindow_obs=timewindow_obs, timings=timings)
+        nobs = call.df.shape[0] if hasattr(call, 'df') else 0
+
+        def nights_done(done, total):
+            set_progress((10+80*done//total,
+                          'Visibility: {}/{} nights, {} OBs'.format(done, total, nobs)))
+
+        set_progress((10, 'Visibility: {} OBs'.format(nobs)))
+        db = create_database(call, nights_done, timings)
+        set_progress((90, 'Building the plot data of {} OBs'.format(nobs)))
+        plot_obj = make_plot_obj(call.df, call.sdate, call.edate, call.edate_user, db, timings)
+        pgms = list(plot_obj.longdf.program.unique())
+        state = {'call': call, 'plot_obj': plot_obj, 'pgms': pgms, 'pgm_select': pgms.copy(),
+                 'timings': timings, 'windows': (db.windows_found, db.windows_computed)}
+        # kept for the jobs waiting for this query
+        job_cache.set('result-'+key, state, expire=cfg.job_result_ttl)
+    finally:
+        job_cache.delete(lock)
+
+    return state
+
+
+def make_fig(plot_obj, display, groupby, pgms, timewindow_obs, use_filter_schedule, timings=None):
+    with metrics.span('figure', timings):
+        return build_fig(plot_obj, display, groupby, pgms, timewindow_obs, use_filter_schedule)
+
+
+def build_fig(plot_obj, display, groupby, pgms, timewindow_obs, use_filter_schedule):
 
     if plot_obj.nights_list == []:    # return empty figure if no queue nights in period
         return []
@@ -64,6 +177,17 @@ def make_fig(plot_obj, display, groupby, pgms, timewindow_obs, use_filter_schedu
 
     plot_obj.groupby = groupby
 
+    key = (plot_obj.query_id, display, groupby, tuple(sorted(pgms or [])),
+           timewindow_obs, use_filter_schedule)
+    plotly_fig = figure_cache.get(key)
+    if plotly_fig is not None:
+        logger.info("Using the cached figure")
+        metrics.count('figures', 'hit')
+        return dcc.Graph(figure=plotly_fig),
+    metrics.count('figures', 'miss')
+
+    logger.info("Calling Plot functions in Plot object")
+
     if display == "OBs":
         plotly_fig = plot_obj.fill_plot()
     elif display == "program":
@@ -81,12 +205,14 @@ def make_fig(plot_obj, display, groupby, pgms, timewindow_obs, use_filter_schedu
             'x': 0.55,
             'xanchor': 'left'},
         height=1000)
+    figure_cache.put(key, plotly_fig)
 
     fig = dcc.Graph(figure=plotly_fig),
 
     return fig
 
 
+@metrics.span('summary')
 def get_summary_info(call, plot_obj):
 
     logger.info("Creating the summary Tab")
@@ -128,26 +254,28 @@ def get_summary_info(call, plot_obj):
 
     return layout
 
-def get_table(df, virtualization=True, height='500px', lineHeight='20px', sort_action='native', minwidth='90px', maxwidth='90px', tooltip_duration=None):
+def get_table(df, virtualization=True, height='500px', lineHeight='20px', sort_action='native', minwidth='90px', maxwidth='90px', tooltip_duration=None, server_side=False):
+
+    if server_side:
+        # empty table, its pages are served by table_page() when it is displayed
+        options = dict(id='ob-table', data=[], tooltip_data=[], virtualization=False,
+                       page_action='custom', page_current=0, page_size=cfg.table_page_size,
+                       sort_action='custom', sort_mode='single',
+                       filter_action='custom', filter_query='')
+    else:
+        records = df.to_dict('records')
+        options = dict(data=records, tooltip_data=get_tooltips(records),
+                       virtualization=virtualization, sort_action=sort_action)
 
     table = dash_table.DataTable(
         columns=[
             {"name": i, "id": i} for i in df
         ],
-        data=df.to_dict('records'),
         fixed_rows={'headers': True},
-        virtualization=virtualization,
-        tooltip_data=[
-            {
-                column: {'value': str(value), 'type': 'markdown'}
-                for column, value in row.items()
-            } for row in df.to_dict('records')
-        ],
         style_table={'height': height},
         tooltip_delay=0,
         tooltip_duration=tooltip_duration,
-        sort_action=sort_action,
-        # filter_action='native',
+        **options,
         style_cell={'minWidth': minwidth,
                     'maxWidth': maxwidth, 'lineHeight': lineHeight},
         style_data={'lineHeight': lineHeight},
@@ -157,15 +285,119 @@ def get_table(df, virtualization=True, height='500px', lineHeight='20px', sort_a
 
     return table
 
-def make_log(call, plot_obj):
+def get_tooltips(records):
+    return [
+        {
+            column: {'value': str(value), 'type': 'markdown'}
+            for column, value in row.items()
+        } for row in records
+    ]
+
+
+def table_df(plot_obj, active_tab):
+    # DataFrame shown in each tab of the OB tables
+    if active_tab == '1':
+        return display_floats(plot_obj.df)
+    elif active_tab == '2':
+        return display_floats(plot_obj.df.loc[plot_obj.df.index.isin(plot_obj.longdf_user.ob_index)])
+    elif active_tab == '3':
+        return plot_obj.queuenightschedule_df
+
+
+def display_floats(df):
+    # float32 columns as the float64 values they print as (123.4, not 123.4000015258789),
+    # for the table cells, tooltips, sorting and filtering
+    columns = df.columns[df.dtypes == np.float32]
+    if len(columns) == 0:
+        return df
+    return df.assign(**{column: df[column].astype(str).astype(float) for column in columns})
+
+
+# DataTable filter operators, as written in the filter_query ('eq', '=' ...) and as Series methods
+filter_operators = [(('ge ', '>='), 'ge'), (('le ', '<='), 'le'), (('lt ', '<'), 'lt'),
+                    (('gt ', '>'), 'gt'), (('ne ', '!='), 'ne'), (('eq ', '='), 'eq'),
+                    (('contains ',), 'contains'), (('datestartswith ',), 'datestartswith')]
+
+
+def split_filter_part(filter_part):
+    # '{column} op value' to (column, operator, value); the operator is the token
+    # right after the column, so that a value like "gene x" is not split at 'ne '
+    start, end = filter_part.find('{'), filter_part.find('}')
+    if start < 0 or end < start:
+        return None, None, None
+    column, rest = filter_part[start + 1: end], filter_part[end + 1:].lstrip()
+    for names, operator in filter_operators:
+        for name in names:
+            if not rest.startswith(name):
+                continue
+            value = rest[len(name):].strip()
+            if len(value) > 0 and value[0] == value[-1] and value[0] in ('"', "'", '`'):
+                value = value[1:-1].replace('\\' + value[0], value[0])
+            else:
+                try:
+                    value = float(value)
+                except ValueError:
+                    pass
+            return column, operator, value
+    return None, None, None
+
+
+def filter_table(df, filter_query):
+    """Rows of df matching a DataTable filter_query ('{col} op value && ...')."""
+
+    for filter_part in (filter_query or '').split(' && '):
+        column, operator, value = split_filter_part(filter_part)
+        if column not in df:
+            continue
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype(object)
+        if operator == 'contains':
+            mask = values.astype(str).str.contains(str(value), case=False, regex=False)
+        elif operator == 'datestartswith':
+            mask = values.astype(str).str.startswith(str(value))
+        else:
+            try:
+                mask = getattr(values, operator)(value)
+            except TypeError:
+                # e.g. a number compared with strings: compare the texts
+                mask = getattr(values.astype(str), operator)(str(value))
+        df = df.loc[mask.fillna(False).astype(bool)]
+    return df
+
+
+@metrics.span('table')
+def table_page(df, page_current, page_size, sort_by, filter_query):
+    """One page of a server side table: records, their tooltips and the number of pages."""
+
+    df = filter_table(df, filter_query)
+    if sort_by:
+        df = df.sort_values(sort_by[0]['column_id'],
+                            ascending=sort_by[0]['direction'] == 'asc', kind='stable')
+    page = df.iloc[page_current*page_size: (page_current+1)*page_size]
+    records = page.to_dict('records')
+    page_count = max(1, -(-df.shape[0]//page_size))
+    return records, get_tooltips(records), page_count
+
+
+def make_log(call, plot_obj, timings=None, windows=None):
 
     logger.info("Creating the log widget in dashboard")
     Nquery = plot_obj.df.shape[0]
-    Nobservable = plot_obj.longdf_user.name.unique().shape[0]
+    Nobservable = plot_obj.longdf_user.ob_index.unique().shape[0]
     queue_nights = len(plot_obj.nights_list) > 0
-    log = 'Queried OBs: {} | Observable OBs: {}'.format(Nquery, Nobservable)
+    memory = sum(plot_obj.memory_usage().values())/2**20
+    log = 'Queried OBs: {} | Observable OBs: {} | OB-nights: {} | Memory: {:.1f} MB'.format(
+        Nquery, Nobservable, plot_obj.longdf_user.shape[0], memory)
     layout = [html.P(log)]
 
+    # time of the query stages, and where the visibility windows came from
+    if timings:
+        layout += [html.P('Timings: ' + ' | '.join(
+            '{}: {:.2f} s'.format(stage, seconds) for stage, seconds in timings.items()))]
+    if windows is not None:
+        layout += [html.P('Visibility windows: {} from the database, {} computed'.format(*windows))]
+
     # check if max limit of OBs was reached for programs
     if len(call.skipped_pgm) > 0:
         warning = '== Warning: Max Limit of OBs ({}) was reached in: {}'.format(
@@ -0,0 +1,84 @@
+"""Scaling of the OB filtering stages of qplan_caller.Call.
+
+Compares Call.get_observable_obs and Call.update_pgms with the list-based
+versions they replaced, on fake queues of increasing size:
+
+    python -m benchmarks.bench_obfilter [--obs 1000 5000 20000]
+"""
+import logging
+import time
+from argparse import ArgumentParser
+
+import qplan_caller
+from benchmarks import fake_qplan
+
+
+def observable_obs_lists(call):
+    # previous version: OB names looked up in a list, one list per program counter
+    keys = list(call.qq.get_schedulable_ob_keys())
+    keys_names = [key[1] for key in keys]
+    obs_all = []
+    pgm_count = {}
+    for ob in call.obs:
+        num = pgm_count.setdefault(ob.program.proposal, [])
+        if len(num) >= call.maxOBquery:
+            if ob.program.proposal not in call.skipped_pgm:
+                call.skipped_pgm.append(ob.program.proposal)
+            continue
+        if ob.name in keys_names:
+            num += [1, ]
+            obs_all.append(ob)
+    return obs_all
+
+
+def observable_obs_sets(call):
+    # the schedulable keys are fetched by Call.get_queue_keys before get_observable_obs
+    call.schedulable_keys = set((key[0], key[1]) for key in call.qq.get_schedulable_ob_keys())
+    return call.get_observable_obs()
+
+
+def update_pgms_lists(call):
+    newpgms = [ob.program.proposal for ob in call.obs]
+    return [pgm for pgm in call.pgms if pgm.proposal in newpgms]
+
+
+def make_call(qq, maxOBquery):
+    call = qplan_caller.Call.__new__(qplan_caller.Call)
+    call.qq = qq
+    call.obs = list(qq.obs)
+    call.pgms = list(qq.programs.values())
+    call.maxOBquery = maxOBquery
+    call.skipped_pgm = []
+    call.logger = logging.getLogger('bench')
+    return call
+
+
+def timed(func, *args):
+    t0 = time.time()
+    result = func(*args)
+    return time.time() - t0, result
+
+
+def main():
+
+    argprs = ArgumentParser(description=__doc__)
+    argprs.add_argument('--obs', type=int, nargs='+', default=[1000, 5000, 20000])
+    argprs.add_argument('--programs', type=int, default=50)
+    argprs.add_argument('--max-obs', dest='maxOBquery', type=int, default=300)
+    options = argprs.parse_args()
+
+    print('{:>8} {:>12} {:>12} {:>12} {:>12}'.format(
+        'OBs', 'lists [s]', 'sets [s]', 'pgms lists', 'pgms sets'))
+    for n_obs in options.obs:
+        qq = fake_qplan.make_queue(options.programs, n_obs)
+        t_lists, obs_lists = timed(observable_obs_lists, make_call(qq, options.maxOBquery))
+        t_sets, obs_sets = timed(observable_obs_sets, make_call(qq, options.maxOBquery))
+        t_pgm_lists, _ = timed(update_pgms_lists, make_call(qq, options.maxOBquery))
+        t_pgm_sets, _ = timed(make_call(qq, options.maxOBquery).update_pgms)
+        assert [ob.name for ob in obs_lists] == [ob.name for ob in obs_sets]
+        print('{:8d} {:12.4f} {:12.4f} {:12.4f} {:12.4f}'.format(
+            n_obs, t_lists, t_sets, t_pgm_lists, t_pgm_sets))
+
+
+if __name__ == '__main__':
+    main()
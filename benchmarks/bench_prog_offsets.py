@@ -0,0 +1,76 @@
+"""Y offsets of the program plot (Plot.fill_plot_prog) on a synthetic longdf.
+
+Compares Plot.get_prog_offsets with the per-program loop it replaced:
+
+    python -m benchmarks.bench_prog_offsets [--rows 10000 100000] [--programs 50]
+"""
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+import qvis_config as cfg
+import qvis_plot
+
+
+def prog_offsets_loop(longdf, groupby):
+    # previous version: one pass over the frame per program, with Python lambdas
+    pgms = longdf.program.unique()
+    mapping_prog = {item: i for i, item in enumerate(pgms)}
+    Yval = longdf['program'].astype(object).apply(lambda x: mapping_prog[x])
+    Yval_offset = Yval
+    for pgm in pgms:
+        df = longdf.loc[longdf.program == pgm]
+        mapping = {item: i for i, item in enumerate(df[groupby].unique())}
+        offsets = df[groupby].astype(object).apply(lambda x: mapping[x])
+        offsets = offsets-((len(mapping)-1)/2.0)
+        offsets = offsets/max(1, max(offsets))*0.35
+        Yval_offset = Yval_offset.add(offsets, fill_value=0)
+    return pgms, Yval_offset
+
+
+def make_longdf(n_rows, n_programs, seed=0):
+    # OB-nights of random programs, filters, targets and constraints, sorted like Plot.get_longdf
+    rng = np.random.default_rng(seed)
+    programs = ['S22B-{:03d}'.format(k) for k in range(n_programs)]
+    longdf = pd.DataFrame({
+        'ob_index': rng.integers(0, n_rows//5 + 1, n_rows),
+        'program': pd.Categorical(rng.choice(programs, n_rows)),
+        'grade': pd.Categorical(rng.choice(list(cfg.grade_dict), n_rows)),
+        'inscfg_filter': pd.Categorical(rng.choice(['g', 'r2', 'i2', 'z', 'y', 'nb921'], n_rows)),
+        'envcfg_seeing': rng.choice([0.8, 1.0, 1.3, 1.6, 100.], n_rows),
+        'envcfg_airmass': rng.choice([1.2, 1.5, 2.0, 2.5], n_rows),
+        'envcfg_moon': pd.Categorical(rng.choice(['dark', 'gray'], n_rows)),
+        'target_name': pd.Categorical(rng.choice(['target{}'.format(k) for k in range(500)], n_rows)),
+    })
+    return longdf.sort_values(by=['grade', 'program'])
+
+
+def main():
+
+    argprs = ArgumentParser(description=__doc__)
+    argprs.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    argprs.add_argument('--programs', type=int, default=50)
+    argprs.add_argument('--groupby', nargs='+',
+                        default=['program', 'inscfg_filter', 'envcfg_airmass', 'target_name'])
+    options = argprs.parse_args()
+
+    plot = qvis_plot.Plot.__new__(qvis_plot.Plot)
+    print('{:>8} {:>15} {:>10} {:>12}'.format('rows', 'group by', 'loop [s]', 'vector [s]'))
+    for n_rows in options.rows:
+        longdf = make_longdf(n_rows, options.programs)
+        for groupby in options.groupby:
+            plot.groupby = groupby
+            t0 = time.time()
+            pgms_loop, offsets_loop = prog_offsets_loop(longdf, groupby)
+            t1 = time.time()
+            pgms, offsets = plot.get_prog_offsets(longdf)
+            t2 = time.time()
+            assert list(pgms) == list(pgms_loop)
+            assert np.allclose(offsets, offsets_loop.loc[longdf.index].values)
+            print('{:8d} {:>15} {:10.4f} {:12.4f}'.format(n_rows, groupby, t1 - t0, t2 - t1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Time the queue database part of qplan_caller.Call against the fake queue.
+
+    python -m benchmarks.bench_qdb_fetch [--latency 0.005] [--workers 1 4 8]
+
+The fake queue connections, like ZODB connections, fail when shared by two
+threads, and the OBs must be the same with any number of workers.
+"""
+import logging
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+from datetime import datetime
+
+import diskcache
+
+import qvis_config as cfg
+import qvis_cache
+import qplan_caller
+from benchmarks import fake_qplan
+
+
+def main():
+
+    argprs = ArgumentParser(description=__doc__)
+    argprs.add_argument('--programs', type=int, default=50)
+    argprs.add_argument('--obs', type=int, default=5000)
+    argprs.add_argument('--latency', type=float, default=0.005,
+                        help='seconds per queue database call')
+    argprs.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    options = argprs.parse_args()
+
+    logger = logging.getLogger('bench')
+    sdate = datetime(2022, 8, 1)
+    qq = fake_qplan.make_queue(options.programs, options.obs, latency=options.latency)
+    with tempfile.TemporaryDirectory() as path:
+        fake_qplan.write_spreadsheets(qq, path, sdate, 1)
+        fake_qplan.use_fake_queue(qq, cfg, path)
+        qvis_cache.call_cache = qplan_caller.call_cache = diskcache.Cache(os.path.join(path, 'queries'))
+        obs = None
+        for workers in options.workers:
+            cfg.qdb_workers = workers
+            qplan_caller.call_cache.clear()
+            qq.stats.update(calls=0, connections=1)
+            t0 = time.time()
+            call = qplan_caller.Call(list(cfg.grade_dict), cfg.seeing_options, cfg.transp_options,
+                                     list(cfg.filters_dict), sdate, sdate, 9999, False, logger)
+            seconds = time.time()-t0
+            # Call logs the exceptions: no results if a connection was shared
+            assert hasattr(call, 'df'), 'query failed with qdb_workers={}'.format(workers)
+            if obs is None:
+                obs = list(call.df.id)
+            assert list(call.df.id) == obs, 'other OBs with qdb_workers={}'.format(workers)
+            print('qdb_workers={:2d}: {:6.2f} s, {} queue calls, {} connections, {} OBs'.format(
+                workers, seconds, qq.calls, qq.stats['connections'], call.df.shape[0]))
+
+
+if __name__ == '__main__':
+    main()
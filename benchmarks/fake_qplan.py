@@ -0,0 +1,196 @@
+"""Local stand-in for the Gen2 queue database.
+
+FakeQueueQuery answers the qplan q_query.QueueQuery calls made by
+qplan_caller.Call from synthetic programs and OBs, optionally sleeping
+'latency' seconds per call to mimic the round trips to the queue database.
+write_spreadsheets writes the matching Queue spreadsheet files.
+
+Run from the qvis_dash directory (qvis_config.yaml is read from there).
+"""
+import copy
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytz
+
+import qplan_caller
+
+local = pytz.timezone("US/Hawaii")
+
+seeing_values = [0.8, 1.0, 1.3, 1.6, 100.]
+transp_values = [0.7, 0.4, 0.1, 0.0]
+filter_values = ['g', 'r2', 'i2', 'z', 'y', 'nb921']
+
+
+class Entity:
+    """Attribute container with a qplan-like to_rec()."""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def to_rec(self):
+        rec = {}
+        for key, value in self.__dict__.items():
+            if isinstance(value, Entity):
+                # OBs refer to their program by proposal in records
+                value = value.proposal if key == 'program' else value.to_rec()
+            elif key in ('obs', 'spsheet_obs'):    # set on programs by Call
+                continue
+            rec[key] = value
+        return rec
+
+
+class FakeQueueQuery:
+    """One connection to the fake queue database.
+
+    Like a ZODB connection, a connection may only be used by one thread: it
+    raises RuntimeError when a second thread uses it.  connect() opens another
+    connection to the same data.
+    """
+
+    def __init__(self, programs, obs, executed, latency=0.0):
+        self.programs = {pgm.proposal: pgm for pgm in programs}
+        self.obs = obs
+        self.executed = set(executed)
+        self.latency = latency
+        self.thread = None
+        # shared by the connections: number of calls and of connections
+        self.stats = {'calls': 0, 'connections': 1}
+        self.lock = threading.Lock()
+
+    @property
+    def calls(self):
+        return self.stats['calls']
+
+    @calls.setter
+    def calls(self, value):
+        self.stats['calls'] = value
+
+    def connect(self):
+        qq = copy.copy(self)
+        qq.thread = None
+        with self.lock:
+            self.stats['connections'] += 1
+        return qq
+
+    def wait(self):
+        thread = threading.get_ident()
+        if self.thread is None:
+            self.thread = thread
+        elif self.thread != thread:
+            raise RuntimeError('queue database connection used by two threads')
+        with self.lock:
+            self.stats['calls'] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def get_program(self, proposal):
+        self.wait()
+        return self.programs[proposal]
+
+    def get_obs_by_proposal(self, proposal):
+        self.wait()
+        return [ob for ob in self.obs if ob.program.proposal == proposal]
+
+    def get_schedulable_ob_keys(self):
+        self.wait()
+        return [(ob.program.proposal, ob.name) for ob in self.obs
+                if (ob.program.proposal, ob.name) not in self.executed]
+
+    def get_do_not_execute_ob_keys(self):
+        self.wait()
+        return list(self.executed)
+
+    def _ob_keys_to_obs(self, keys):
+        self.wait()
+        obs = {(ob.program.proposal, ob.name): ob for ob in self.obs}
+        return [{'program': key[0], 'name': key[1], 'total_time': obs[key].total_time}
+                for key in keys]
+
+
+def make_queue(n_programs=50, n_obs=5000, executed_frac=0.1, time_window_frac=0.05,
+               semester_start=datetime(2022, 8, 1), latency=0.0, seed=0, night_time_windows=0):
+    """Synthetic queue of n_programs programs with n_obs OBs in total.
+
+    Time windows run from 20:00 to 20:00 local, over the semester.  With
+    night_time_windows=N they start and end at random times of the night
+    instead, in the first N nights, so that they open and close during the
+    visibility windows.
+    """
+
+    rng = np.random.default_rng(seed)
+    programs = [Entity(proposal='S22B-{:03d}'.format(k+1), grade=rng.choice(['A', 'B', 'C', 'F']),
+                       total_time=float(rng.uniform(5, 50)*3600))
+                for k in range(n_programs)]
+    # 20 targets per program, shared by its OBs
+    positions = np.stack([rng.uniform(0, 360, (n_programs, 20)),
+                          rng.uniform(-30, 70, (n_programs, 20))], axis=-1)
+    obs = []
+    for k in range(n_obs):
+        p = rng.integers(n_programs)
+        pgm, target = programs[p], rng.integers(20)
+        lower = upper = None
+        if rng.random() < time_window_frac:
+            if night_time_windows > 0:
+                lower = local.localize(semester_start+timedelta(
+                    days=int(rng.integers(night_time_windows)), hours=float(rng.uniform(19, 30))))
+                upper = lower + timedelta(hours=float(rng.uniform(0.5, 24*night_time_windows)))
+            else:
+                lower = local.localize(semester_start+timedelta(days=int(rng.integers(150)), hours=20))
+                upper = lower + timedelta(days=int(rng.integers(1, 30)))
+        obs.append(Entity(
+            id='ob{:06d}'.format(k), program=pgm, name='ob{:04d}'.format(k),
+            target=Entity(name='{}-t{}'.format(pgm.proposal, target),
+                          ra=float(positions[p, target, 0]), dec=float(positions[p, target, 1])),
+            inscfg=Entity(filter=str(rng.choice(filter_values))),
+            telcfg=Entity(min_el=float(rng.choice([15., 30., 40.]))),
+            envcfg=Entity(seeing=float(rng.choice(seeing_values)),
+                          transparency=float(rng.choice(transp_values)),
+                          airmass=float(rng.choice([1.5, 2.0, 3.0])),
+                          moon=str(rng.choice(['dark', 'gray'])),
+                          moon_sep=float(rng.choice([30., 60.])),
+                          lower_time_limit=lower, upper_time_limit=upper),
+            total_time=float(rng.uniform(600, 3600)),
+            comment='synthetic OB {} of {}'.format(k, pgm.proposal)))
+    executed = [(ob.program.proposal, ob.name) for ob in obs if rng.random() < executed_frac]
+    return FakeQueueQuery(programs, obs, executed, latency=latency)
+
+
+def write_spreadsheets(qq, path, sdate, n_nights):
+    """Write programs.xlsx, <proposal>.xlsx and schedule.xlsx of the fake queue in 'path'.
+
+    Every night of the period is a queue night, with all filters available.
+    """
+    os.makedirs(path, exist_ok=True)
+    pd.DataFrame({'proposal': list(qq.programs)}).to_excel(
+        os.path.join(path, 'programs.xlsx'), index=False)
+    for proposal in qq.programs:
+        codes = [ob.name for ob in qq.obs if ob.program.proposal == proposal]
+        pd.DataFrame({'Code': codes}).to_excel(
+            os.path.join(path, proposal+'.xlsx'), sheet_name='ob', index=False)
+    dates = [sdate.date()+timedelta(days=k) for k in range(n_nights)]
+    pd.DataFrame({'date': dates, 'start time': '19:00:00', 'end time': '05:30:00',
+                  'filters': ','.join(filter_values)}).to_excel(
+        os.path.join(path, 'schedule.xlsx'), index=False)
+
+
+def use_fake_queue(qq, cfg, path):
+    """Point qplan_caller.Call and the spreadsheet paths at the fake queue."""
+
+    def open_queue(self):
+        # a new connection, for its own thread
+        return None, None, qq.connect()
+
+    def connect(self):
+        self.qq = qq
+        self.worker_queues = []
+
+    qplan_caller.Call.connect = connect
+    qplan_caller.Call.open_queue = open_queue
+    cfg.progfile_path = os.path.join(path, 'programs.xlsx')
+    cfg.allprogfile_path = path
+    cfg.schedpath_text = os.path.join(path, 'schedule.xlsx')
@@ -0,0 +1,139 @@
+"""Time each stage of a query, from the queue database to the figures, on a fake queue.
+
+Generates a synthetic queue (programs, OBs, targets, spreadsheets and queue
+schedule, see fake_qplan), runs the app pipeline on it with empty caches and
+again with the caches filled, and appends the timings to a JSON lines file
+together with the commit and the scale, to compare versions:
+
+    python -m benchmarks.run [--programs 50] [--obs 5000] [--nights 180] [--output FILE]
+"""
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+
+import diskcache
+import numpy as np
+import pandas as pd
+
+import qvis_config as cfg
+import qvis_cache
+import qvis_visibility as vis
+import qplan_caller
+import qvis_database
+import qvis_plot
+from benchmarks import fake_qplan
+
+
+def timed(stages, name, func, *args):
+    t0 = time.time()
+    result = func(*args)
+    stages[name] = round(time.time() - t0, 4)
+    print('{:>28} {:10.3f} s'.format(name, stages[name]))
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def use_temp_caches(path):
+    # database, query results and parsed spreadsheets of this run only
+    cfg.database_path = os.path.join(path, 'database.sqlite3')
+    cfg.sheet_cache_path = ''
+    qplan_caller.call_cache = qvis_cache.call_cache = diskcache.Cache(os.path.join(path, 'queries'))
+
+
+def clear_caches():
+    qplan_caller.call_cache.clear()
+    qvis_cache.sheet_cache.clear()
+    vis.track_cache.clear()
+
+
+def run_pipeline(stages, suffix, options, sdate, edate, logger):
+
+    call = timed(stages, 'Call'+suffix, qplan_caller.Call, list(cfg.grade_dict), cfg.seeing_options,
+                 cfg.transp_options, list(cfg.filters_dict), sdate, edate, options.maxOBquery,
+                 False, logger)
+    db = timed(stages, 'DataBase'+suffix, qvis_database.DataBase, call, logger)
+    plot = timed(stages, 'Plot'+suffix, qvis_plot.Plot, call.df, call.sdate, call.edate,
+                 call.edate_user, db)
+    return call, db, plot
+
+
+def main():
+
+    argprs = ArgumentParser(description=__doc__)
+    argprs.add_argument('--programs', type=int, default=50)
+    argprs.add_argument('--obs', type=int, default=5000)
+    argprs.add_argument('--nights', type=int, default=180)
+    argprs.add_argument('--latency', type=float, default=0.0,
+                        help='seconds per queue database call')
+    argprs.add_argument('--max-obs', dest='maxOBquery', type=int, default=max(cfg.maxOBquery_arr))
+    argprs.add_argument('--workers', type=int, default=cfg.visibility_workers,
+                        help='processes computing the visibility windows')
+    argprs.add_argument('--method', default=cfg.visibility_method,
+                        help='visibility method (see visibility_method in qvis_config.yaml)')
+    argprs.add_argument('--seed', type=int, default=0)
+    argprs.add_argument('--output', default='benchmarks/results.jsonl',
+                        help='JSON lines file the results are appended to')
+    options = argprs.parse_args()
+
+    cfg.visibility_workers = options.workers
+    cfg.visibility_method = options.method
+    logger = logging.getLogger('bench')
+    sdate = datetime(2022, 8, 1)
+    edate = sdate + timedelta(days=options.nights-1)
+    stages = {}
+
+    with tempfile.TemporaryDirectory() as path:
+        t0 = time.time()
+        qq = fake_qplan.make_queue(options.programs, options.obs, latency=options.latency,
+                                   semester_start=sdate, seed=options.seed)
+        fake_qplan.write_spreadsheets(qq, path, sdate, options.nights+2)
+        fake_qplan.use_fake_queue(qq, cfg, path)
+        use_temp_caches(path)
+        print('fake queue: {} programs, {} OBs, {} nights ({:.1f} s)'.format(
+            options.programs, options.obs, options.nights, time.time() - t0))
+
+        clear_caches()
+        run_pipeline(stages, ' (cold)', options, sdate, edate, logger)
+        call, db, plot = run_pipeline(stages, ' (warm)', options, sdate, edate, logger)
+
+        timed(stages, 'get_longdf', plot.get_longdf)
+        pgms = list(plot.longdf.program.unique())
+        timed(stages, 'update_longdf', plot.update_longdf, pgms, False, True)
+        timed(stages, 'update_longdf (half pgms)', plot.update_longdf, pgms[::2], False, True)
+        plot.update_longdf(pgms, False, True)
+        plot.groupby = 'program'
+        for name in ['fill_plot', 'fill_plot_prog', 'fill_plot_num', 'fill_plot_TotTime',
+                     'fill_plot_completion']:
+            timed(stages, name, getattr(plot, name))
+
+    result = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'scale': {'programs': options.programs, 'obs': options.obs, 'nights': options.nights,
+                  'latency': options.latency, 'max_obs': options.maxOBquery,
+                  'workers': options.workers, 'method': options.method, 'seed': options.seed},
+        'size': {'queried_obs': int(call.df.shape[0]), 'ob_nights': int(plot.longdf.shape[0])},
+        'versions': {'python': platform.python_version(), 'numpy': np.__version__,
+                     'pandas': pd.__version__},
+        'stages': stages,
+    }
+    with open(options.output, 'a') as f:
+        f.write(json.dumps(result)+'\n')
+    print('results appended to {}'.format(options.output))
+
+
+if __name__ == '__main__':
+    main()
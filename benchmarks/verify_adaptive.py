@@ -0,0 +1,113 @@
+"""Check the 'adaptive' visibility windows against the 'step' and 'vector' methods.
+
+Computes the windows of a fake queue with each method, from an empty
+database, and reports the windows that differ and by how much:
+
+    python -m benchmarks.verify_adaptive [--programs 10] [--obs 300] [--nights 5] [--coarse-step 30 60]
+
+By default half of the OBs have a time window opening and closing during
+the nights, to check the windows cut by them.
+
+'step' runs the original 5-min stepping with subaru.calc, so keep the queue
+small.  With adaptive_precision 5 the windows should be the same as 'vector'.
+"""
+import logging
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+import qvis_config as cfg
+import qplan_caller
+import qvis_database
+from benchmarks import fake_qplan
+from benchmarks.run import use_temp_caches, clear_caches
+
+
+def night_windows(call, method, path, logger):
+    # windows of every OB and night, from a new database
+    cfg.visibility_method = method
+    cfg.database_path = os.path.join(path, 'database-{}-{}.sqlite3'.format(
+        method, cfg.adaptive_coarse_step))
+    clear_caches()
+    t0 = time.time()
+    db = qvis_database.DataBase(call, logger)
+    seconds = time.time() - t0
+    keys = qvis_database.window_keys(call.df, call.request_windows)
+    windows = {}
+    for date, nw in db.nightvis_info.items():
+        for i, key in enumerate(keys):
+            window = nw.targ_dic[key]
+            windows[(date, i)] = (window['window_start'], window['window_end'])
+    return windows, seconds
+
+
+def compare(windows, reference):
+    # number of windows that differ, and largest start/end difference in minutes
+    differ, max_start, max_end = 0, 0.0, 0.0
+    for key, (start, end) in windows.items():
+        ref_start, ref_end = reference[key]
+        if (start, end) == (ref_start, ref_end):
+            continue
+        differ += 1
+        if start is None or ref_start is None:
+            max_start = max_end = float('inf')
+            continue
+        max_start = max(max_start, abs(pd.Timestamp(start) - pd.Timestamp(ref_start)).total_seconds()/60)
+        max_end = max(max_end, abs(pd.Timestamp(end) - pd.Timestamp(ref_end)).total_seconds()/60)
+    return differ, max_start, max_end
+
+
+def main():
+
+    argprs = ArgumentParser(description=__doc__)
+    argprs.add_argument('--programs', type=int, default=10)
+    argprs.add_argument('--obs', type=int, default=300)
+    argprs.add_argument('--nights', type=int, default=5)
+    argprs.add_argument('--coarse-step', dest='coarse_step', type=int, nargs='+', default=[30, 60],
+                        help='adaptive_coarse_step values to check, in minutes')
+    argprs.add_argument('--time-window-frac', dest='time_window_frac', type=float, default=0.5,
+                        help='fraction of OBs with a time window during the nights')
+    argprs.add_argument('--seed', type=int, default=0)
+    options = argprs.parse_args()
+
+    cfg.visibility_workers = 1
+    cfg.adaptive_precision = qvis_database.minute_delta
+    logger = logging.getLogger('bench')
+    sdate = datetime(2022, 8, 1)
+    edate = sdate + timedelta(days=options.nights-1)
+
+    with tempfile.TemporaryDirectory() as path:
+        qq = fake_qplan.make_queue(options.programs, options.obs, semester_start=sdate,
+                                   time_window_frac=options.time_window_frac,
+                                   night_time_windows=options.nights, seed=options.seed)
+        fake_qplan.write_spreadsheets(qq, path, sdate, options.nights+2)
+        fake_qplan.use_fake_queue(qq, cfg, path)
+        use_temp_caches(path)
+        call = qplan_caller.Call(list(cfg.grade_dict), cfg.seeing_options, cfg.transp_options,
+                                 list(cfg.filters_dict), sdate, edate, max(cfg.maxOBquery_arr),
+                                 False, logger)
+
+        step, step_seconds = night_windows(call, 'step', path, logger)
+        vector, vector_seconds = night_windows(call, 'vector', path, logger)
+        print('{} OBs, {} nights: {} windows'.format(call.df.shape[0], options.nights, len(step)))
+        print('{:>22} {:>10} {:>8} {:>14} {:>12}'.format(
+            'method', 'time [s]', 'differ', 'start [min]', 'end [min]'))
+        print('{:>22} {:10.2f}'.format('step', step_seconds))
+        print('{:>22} {:10.2f} {:8d} {:14.1f} {:12.1f}'.format(
+            'vector', vector_seconds, *compare(vector, step)))
+        for coarse_step in options.coarse_step:
+            cfg.adaptive_coarse_step = coarse_step
+            adaptive, seconds = night_windows(call, 'adaptive', path, logger)
+            name = 'adaptive ({} min)'.format(coarse_step)
+            print('{:>22} {:10.2f} {:8d} {:14.1f} {:12.1f}'.format(
+                name, seconds, *compare(adaptive, step)))
+            print('{:>22} {:>10} {:8d} {:14.1f} {:12.1f}'.format(
+                '  vs vector', '', *compare(adaptive, vector)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Check Call.subset (narrower queries of a session) against the same queries made directly.
+
+Queries a fake queue with all options, then narrows the grades, seeing,
+transparency, filters, time windows and dates one at a time, and compares
+the OBs (df) and programs (df_pgm) of Call.subset with those of a new Call:
+
+    python -m benchmarks.verify_subset [--programs 30] [--obs 300] [--executed 0.6]
+
+Exits with an error if any of them differ.
+"""
+import logging
+import os
+import sys
+import tempfile
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+import qvis_config as cfg
+import qplan_caller
+from benchmarks import fake_qplan
+from benchmarks.run import use_temp_caches
+
+
+def differences(subset, call):
+    # names of the results that differ
+    failed = []
+    frames = {'df': (subset.df, call.df), 'df_pgm': (subset.df_pgm, call.df_pgm)}
+    for name, (df1, df2) in frames.items():
+        try:
+            pd.testing.assert_frame_equal(df1.reset_index(drop=True), df2.reset_index(drop=True))
+        except AssertionError:
+            failed.append(name)
+    if subset.skipped_pgm != call.skipped_pgm:
+        failed.append('skipped_pgm')
+    return failed
+
+
+def main():
+
+    argprs = ArgumentParser(description=__doc__)
+    argprs.add_argument('--programs', type=int, default=30)
+    argprs.add_argument('--obs', type=int, default=300)
+    argprs.add_argument('--executed', type=float, default=0.6,
+                        help='fraction of executed OBs')
+    argprs.add_argument('--seed', type=int, default=0)
+    options = argprs.parse_args()
+
+    logger = logging.getLogger('bench')
+    sdate = datetime(2022, 8, 1)
+    edate = sdate + timedelta(days=9)
+    grades, seeing = list(cfg.grade_dict), cfg.seeing_options
+    transp, filters = cfg.transp_options, list(cfg.filters_dict)
+    base = (grades, seeing, transp, filters, sdate, edate, max(cfg.maxOBquery_arr), False)
+    narrower = {
+        'grades': (grades[:2],) + base[1:],
+        'seeing': base[:1] + (seeing[:2],) + base[2:],
+        'transparency': base[:2] + (transp[:2],) + base[3:],
+        'filters g': base[:3] + (['g'],) + base[4:],
+        'filters g, i2, nb': base[:3] + (['g', 'i2', 'nb'],) + base[4:],
+        'time windows': base[:7] + (True,),
+        'dates': base[:4] + (sdate + timedelta(days=2), sdate + timedelta(days=5)) + base[6:],
+        'all': (grades[:2], seeing[1:], transp[:3], ['g', 'r2', 'z'], sdate + timedelta(days=1),
+                sdate + timedelta(days=3), base[6], False),
+    }
+
+    failed = False
+    with tempfile.TemporaryDirectory() as path:
+        qq = fake_qplan.make_queue(options.programs, options.obs, executed_frac=options.executed,
+                                   time_window_frac=0.3, semester_start=sdate, seed=options.seed)
+        fake_qplan.write_spreadsheets(qq, path, sdate, 12)
+        fake_qplan.use_fake_queue(qq, cfg, path)
+        use_temp_caches(path)
+        previous = qplan_caller.Call(*base, logger)
+        print('all options: {} OBs, {} programs'.format(previous.df.shape[0], previous.df_pgm.shape[0]))
+        for name, query in narrower.items():
+            subset = previous.subset(*query)
+            call = qplan_caller.Call(*query, logger)
+            if subset is None:
+                print('{:>20}: not derived'.format(name))
+                continue
+            diff = differences(subset, call)
+            failed |= len(diff) > 0
+            print('{:>20}: {} OBs, {} programs {}'.format(
+                name, call.df.shape[0], call.df_pgm.shape[0],
+                'differ: '+', '.join(diff) if diff else 'same'))
+    if failed:
+        sys.exit('Call.subset differs from Call')
+
+
+if __name__ == '__main__':
+    main()
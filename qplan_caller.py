@@ -1,11 +1,33 @@
 from qplan import q_db, q_query
 from qplan.entity import StaticTarget
 import traceback
+import logging
+import copy
+import time as timer
+import glob
+import hashlib
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
 import qvis_config as cfg
-
+import qvis_metrics as metrics
+from qvis_cache import read_sheet, read_sheets, file_stamp, call_cache
+
+# dtypes of the OB DataFrame columns (the others are inferred): categoricals for
+# repeated strings, float32 for numbers that are not shown as plot labels (the OB
+# tables convert them back, see app_functions.display_floats).
+ob_dtypes = {
+    'program': 'category',
+    'inscfg_filter': 'category',
+    'grade': 'category',
+    'envcfg_moon': 'category',
+    'telcfg_min_el': np.float32,
+    'total_time': np.float32,
+    'acct_time': np.float32,
+}
 
 
 class Call:
@@ -30,48 +52,179 @@ class Call:
         self.timewindow_obs = timewindow_obs
         self.skipped_pgm = []
         self.logger = logger
+        # the results are up to date at this time (see subset)
+        self.query_time = timer.time()
 
         try:
             self.connect()
-            self.pgms = self.get_programs()
-            self.obs = self.get_obs()
-            self.obs = self.get_observable_obs()
-            self.df, self.df_pgm = self.build_df()
-            self.targets = [StaticTarget(name=name, ra=ra, dec=dec) for name, ra, dec in zip(
-                self.df.target_name, self.df.target_ra, self.df.target_dec)]
-            self.request_windows = [(mindate, maxdate) for mindate, maxdate in zip(
-                self.df.envcfg_lower_time_limit, self.df.envcfg_upper_time_limit)]
+            self.get_queue_keys()
+            self.cache_key = self.get_cache_key()
+            cached = call_cache.get(self.cache_key)
+            if cached is not None and len(cached) != 4:
+                cached = None   # results of a previous version
+            metrics.count('queries', 'miss' if cached is None else 'hit')
+            if cached is None:
+                self.pgms = self.get_programs()
+                self.obs = self.get_obs()
+                self.obs = self.get_observable_obs()
+                self.df, self.df_pgm = self.build_df()
+                call_cache.set(self.cache_key, (self.df, self.df_pgm, self.skipped_pgm, self.df_match),
+                               expire=cfg.call_cache_ttl)
+            else:
+                self.logger.info("Using the cached results of the same query")
+                self.df, self.df_pgm, self.skipped_pgm, self.df_match = cached
+            self.set_targets()
 
         except Exception:
             self.logger.exception("Exception occurred")
             traceback.print_exc()
 
+    def __getstate__(self):
+        # the query results only: sessions are pickled between the app processes
+        state = self.__dict__.copy()
+        for attr in ('qdb', 'qa', 'qq', 'worker_queues', 'logger', 'pgms', 'obs', 'targets',
+                     'schedulable_keys', 'executed_keys'):
+            state.pop(attr, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.logger = logging.getLogger('qvis_dash')
+
     def connect(self):
+        self.qdb, self.qa, self.qq = self.open_queue()
+        # connections of the fetch() worker threads, open while their OBs are used
+        self.worker_queues = []
+
+    def open_queue(self):
         # config file for queue db access
         q_conf_file = os.path.join(os.path.abspath('.'), self.qdbfile)
 
         # create handle to queue database (be sure it is running at the chosen address)
-        self.qdb = q_db.QueueDatabase(self.logger)
+        qdb = q_db.QueueDatabase(self.logger)
         try:
-            self.qdb.read_config(q_conf_file)
+            qdb.read_config(q_conf_file)
         except Exception:
             self.logger.exception("Exception occurred")
             traceback.print_exc()
-        self.qdb.connect()
+        qdb.connect()
 
         # make query object
-        self.qa = q_db.QueueAdapter(self.qdb)
-        self.qq = q_query.QueueQuery(self.qa)
+        qa = q_db.QueueAdapter(qdb)
+        return qdb, qa, q_query.QueueQuery(qa)
+
+    def set_targets(self):
+        self.targets = [StaticTarget(name=name, ra=ra, dec=dec) for name, ra, dec in zip(
+            self.df.target_name, self.df.target_ra, self.df.target_dec)]
+        self.request_windows = [(mindate, maxdate) for mindate, maxdate in zip(
+            self.df.envcfg_lower_time_limit, self.df.envcfg_upper_time_limit)]
+
+    def subset(self, grade, seeing, transp, filters, sdate, edate, maxOBquery, timewindow_obs):
+        """Call of a narrower query, made from these results without the queue database.
+
+        Returns None if the query is not within this one (more grades, seeing,
+        ..., dates out of range), if the OBs dropped by the max OBs per program
+        could be needed, or if the results are older than call_cache_ttl.
+        The programs table is made from df_match, like update_pgms, so it
+        keeps the programs whose matching OBs were all executed.
+        """
+        if not hasattr(self, 'df_match') or timer.time() - self.query_time > cfg.call_cache_ttl:
+            return None
+
+        call = copy.copy(self)
+        call.grade, call.seeing, call.transp, call.filters = grade, seeing, transp, filters
+        call.sdate = datetime(sdate.year, sdate.month, sdate.day)+timedelta(hours=12)
+        call.edate = datetime(edate.year, edate.month, edate.day)+timedelta(hours=36)
+        call.edate_user = datetime(edate.year, edate.month, edate.day)+timedelta(hours=12)
+        call.maxOBquery = int(maxOBquery)
+        call.timewindow_obs = timewindow_obs
+
+        if not (set(grade) <= set(self.grade) and set(seeing) <= set(self.seeing) and
+                set(transp) <= set(self.transp) and set(filters) <= set(self.filters) and
+                timewindow_obs >= self.timewindow_obs and
+                call.sdate >= self.sdate and call.edate <= self.edate):
+            return None
+        # OBs beyond the max of a program were not kept: they could match the new query
+        same_obs = (set(seeing) == set(self.seeing) and set(transp) == set(self.transp) and
+                    set(filters) == set(self.filters) and timewindow_obs == self.timewindow_obs)
+        if len(self.skipped_pgm) > 0 and (call.maxOBquery > self.maxOBquery or not same_obs):
+            return None
+
+        df = self.df
+        df = df.loc[df.grade.isin(grade) & ob_ok(df, seeing, transp, filters, timewindow_obs)]
+        # max OBs per program, in the order of the queue database like get_observable_obs
+        rank = df.groupby('program', observed=True).cumcount()
+        skipped = [pgm for pgm in self.skipped_pgm if pgm in set(df.program)]
+        call.skipped_pgm = list(dict.fromkeys(skipped + list(df.program[rank >= call.maxOBquery])))
+        df = df.loc[rank < call.maxOBquery]
+        # the dtypes build_df gives: no unused categories, and time limits that are
+        # all missing are None objects rather than datetimes
+        df = df.assign(**{column: df[column].cat.remove_unused_categories()
+                          for column, dtype in df.dtypes.items()
+                          if isinstance(dtype, pd.CategoricalDtype)})
+        call.df = df.assign(**{column: pd.Series([None]*len(df), index=df.index, dtype=object)
+                               for column in ('envcfg_lower_time_limit', 'envcfg_upper_time_limit')
+                               if column in df and df[column].isna().all()})
+        # programs with matching OBs, observable or not, like update_pgms
+        call.df_match = self.df_match.loc[ob_ok(self.df_match, seeing, transp, filters, timewindow_obs)]
+        call.df_pgm = self.df_pgm.loc[self.df_pgm.grade.isin(grade) &
+                                      self.df_pgm.proposal.isin(set(call.df_match.program))]
+        call.set_targets()
+        return call
+
+    def get_queue_keys(self):
+        # OB keys deciding which OBs are observable and the completion rates
+        self.schedulable_keys = set((key[0], key[1]) for key in self.qq.get_schedulable_ob_keys())
+        self.executed_keys = list(self.qq.get_do_not_execute_ob_keys())
+
+    def get_cache_key(self):
+        """Query options and a fingerprint of the data the query results come from.
+
+        The fingerprint covers the queue database keys and the modification
+        times of the spreadsheets, so any change there makes a new key.  The
+        dates are not part of the key: they do not change the OBs.
+        """
+        files = [self.progfile_path] + sorted(glob.glob(os.path.join(self.allprogfile_path, '*.xlsx')))
+        digest = hashlib.sha1()
+        for item in (sorted(map(repr, self.schedulable_keys)), sorted(map(repr, self.executed_keys)),
+                     [(path, file_stamp(path)) for path in files if os.path.exists(path)]):
+            digest.update(repr(item).encode())
+        return (tuple(sorted(self.grade)), tuple(sorted(self.seeing)), tuple(sorted(self.transp)),
+                tuple(sorted(self.filters)), self.maxOBquery, bool(self.timewindow_obs),
+                digest.hexdigest())
+
+    def fetch(self, func, items):
+        """Return [func(qq, item) for item in items], a per-item queue database lookup.
+
+        With qdb_workers > 1 the round trips overlap in threads.  A queue
+        database (ZODB) connection must not be shared between threads, so each
+        worker thread opens its own QueueQuery.
+        """
+        if cfg.qdb_workers <= 1:
+            return [func(self.qq, item) for item in items]
+
+        local = threading.local()
+
+        def lookup(item):
+            if not hasattr(local, 'qq'):
+                queue = self.open_queue()
+                self.worker_queues.append(queue)
+                local.qq = queue[2]
+            return func(local.qq, item)
+
+        with ThreadPoolExecutor(max_workers=cfg.qdb_workers) as pool:
+            return list(pool.map(lookup, items))
 
     def get_programs(self):
 
         # get programs by program spreadsheet file
         try:
-            df = pd.read_excel(self.progfile_path, engine='openpyxl')
+            df = read_sheet(self.progfile_path)
             # This will drop the rows where ALL elements are missing.
             df = df.dropna(how='all')
-            active_pgms = list(df.proposal)
-            self.pgms = [self.qq.get_program(prog) for prog in active_pgms]
+            # unique proposals, in spreadsheet order
+            active_pgms = list(dict.fromkeys(df.proposal))
+            self.pgms = self.fetch(lambda qq, prop: qq.get_program(prop), active_pgms)
         except Exception:
             self.logger.exception("Exception occurred")
             traceback.print_exc()
@@ -111,7 +264,7 @@ class Call:
 
     def get_exec_OBs(self):
 
-        executedOBs = list(self.qq.get_do_not_execute_ob_keys())
+        executedOBs = self.executed_keys
         pposals = [pgm.proposal for pgm in self.pgms]
         executedOBs = [OB for OB in executedOBs if OB[0] in pposals]
         if len(executedOBs) > 0:
@@ -129,13 +282,14 @@ class Call:
 
         # Get semester OBs from spreadsheet files
         nofiles = []
-        for pgm in self.pgms:
+        sheets = read_sheets([self.allprogfile_path+'/'+pgm.proposal+'.xlsx'
+                              for pgm in self.pgms], 'ob')
+        for pgm, df1 in zip(self.pgms, sheets):
             try:
-                xls = pd.ExcelFile(self.allprogfile_path +
-                                   '/'+pgm.proposal+'.xlsx', engine='openpyxl')
-                df1 = pd.read_excel(xls, 'ob')
+                if isinstance(df1, Exception):
+                    raise df1
                 df1 = df1.loc[df1.Code.notna()]
-                pgm.spsheet_obs = df1.Code.values
+                pgm.spsheet_obs = set(df1.Code.values)
             except Exception:
                 self.logger.exception("Exception occurred")
                 traceback.print_exc()
@@ -144,10 +298,10 @@ class Call:
 
         # Get all OBs in all programs (first OB search including observed OBs)
         obs_all = []
-        for pgm in self.pgms:
-            prop = pgm.proposal
+        obs_pgms = self.fetch(lambda qq, prop: list(qq.get_obs_by_proposal(prop)),
+                              [pgm.proposal for pgm in self.pgms])
+        for pgm, obs in zip(self.pgms, obs_pgms):
             pgm.obs = []
-            obs = list(self.qq.get_obs_by_proposal(prop))
             for ob in obs:
                 if pgm.spsheet_obs is not None and ob.name not in pgm.spsheet_obs:  # skip OB if not in semester spreadsheet
                     continue
@@ -162,31 +316,39 @@ class Call:
         self.obs = obs_all
         # Use the qualifying OBs to update the Program list.
         self.update_pgms()
+        # what is_ob_ok looked at in the qualifying OBs, to narrow the query in subset()
+        self.df_match = pd.DataFrame({
+            'program': pd.Categorical([ob.program.proposal for ob in obs_all]),
+            'inscfg_filter': pd.Categorical([ob.inscfg.filter for ob in obs_all]),
+            'envcfg_seeing': [ob.envcfg.seeing for ob in obs_all],
+            'envcfg_transparency': [ob.envcfg.transparency for ob in obs_all],
+            'envcfg_lower_time_limit': [ob.envcfg.lower_time_limit for ob in obs_all],
+            'envcfg_upper_time_limit': [ob.envcfg.upper_time_limit for ob in obs_all]})
         return self.obs
 
     # Remove Programs from Program list that do not have any qualifying OBs.
     def update_pgms(self):
 
-        newpgms = [ob.program.proposal for ob in self.obs]
+        newpgms = set(ob.program.proposal for ob in self.obs)
         self.pgms = [pgm for pgm in self.pgms if pgm.proposal in newpgms]
 
     def get_observable_obs(self):
 
         # get OBs that can be observed (second OB search to exclude observed OBs)
-        keys = list(self.qq.get_schedulable_ob_keys())
-        keys_names = [key[1] for key in keys]
+        keys = self.schedulable_keys
         obs_all = []
         pgm_count = {}
+        skipped = set(self.skipped_pgm)
         for ob in self.obs:
-            this_name = ob.name
-            # Why am I using a list, and not an int counter??? Weird...
-            num = pgm_count.setdefault(ob.program.proposal, [])
-            if len(num) >= self.maxOBquery:        # skip an OB if it exceeds the Max OBs per program
-                if ob.program.proposal not in self.skipped_pgm:
-                    self.skipped_pgm.append(ob.program.proposal)
+            proposal = ob.program.proposal
+            num = pgm_count.setdefault(proposal, 0)
+            if num >= self.maxOBquery:        # skip an OB if it exceeds the Max OBs per program
+                if proposal not in skipped:
+                    skipped.add(proposal)
+                    self.skipped_pgm.append(proposal)
                 continue
-            if this_name in keys_names:
-                num += [1, ]
+            if (proposal, ob.name) in keys:
+                pgm_count[proposal] = num + 1
                 obs_all.append(ob)
         self.obs = obs_all
         return self.obs
@@ -214,29 +376,29 @@ class Call:
 
     def build_df(self):
 
-        df = {}
-        for ob in self.obs:
-            dictionary = ob.to_rec()
-            for key in dictionary:
+        records = [ob.to_rec() for ob in self.obs]
+        # DataFrame columns from the record keys, e.g. ('envcfg', 'seeing') -> 'envcfg_seeing'
+        columns = []
+        if len(records) > 0:
+            for key, value in records[0].items():
                 if key.startswith('calib'):     # ignore the 'calib_*' entries.
                     continue
-                if type(dictionary[key]) is dict:
-                    for key2 in dictionary[key]:
-                        if key+'_'+key2 in df:  # check if key already in DataFrame dictionary
-                            # add new element to list
-                            df[key+'_'+key2] += [dictionary[key][key2], ]
-                        else:
-                            # create the columns and add elements
-                            df[key+'_'+key2] = [dictionary[key][key2]]
+                if type(value) is dict:
+                    columns += [(key+'_'+key2, key, key2) for key2 in value]
                 else:
-                    if key in df:               # check if key already in DataFrame dictionary
-                        # add new element to list
-                        df[key] += [dictionary[key], ]
-                    else:
-                        # create the columns and add elements
-                        df[key] = [dictionary[key]]
+                    columns.append((key, key, None))
+
+        df = {}
+        for column, key, key2 in columns:
+            if key2 is None:
+                df[column] = [rec[key] for rec in records]
+            else:
+                df[column] = [rec[key][key2] for rec in records]
 
         df = pd.DataFrame(df)
+        for column, dtype in ob_dtypes.items():
+            if column in df:
+                df[column] = df[column].astype(dtype)
         # Retrieve the grade column and move it to the front
         grades = df['grade']
         df.drop('grade', axis=1, inplace=True)
@@ -254,3 +416,15 @@ class Call:
             by=['grade', 'proposal'], ascending=True, inplace=True)
 
         return self.df, self.df_pgm
+
+
+def ob_ok(df, seeing, transp, filters, timewindow_obs):
+    """Mask of the OB rows Call.is_ob_ok accepts, for the OB columns of df."""
+    inscfg_filter = df.inscfg_filter.astype(str)
+    inscfg_filter = inscfg_filter.str.lower().where(~inscfg_filter.str.startswith('nb'), 'nb')
+    keep = (inscfg_filter.isin(filters) &
+            df.envcfg_seeing.map('%.1f'.__mod__).isin(seeing) &
+            df.envcfg_transparency.map('%.1f'.__mod__).isin(transp))
+    if timewindow_obs:
+        keep &= df.envcfg_lower_time_limit.notna() | df.envcfg_upper_time_limit.notna()
+    return keep
@@ -0,0 +1,149 @@
+import glob
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import diskcache
+import pandas as pd
+
+import qvis_config as cfg
+import qvis_metrics as metrics
+
+try:
+    import pyarrow  # noqa: F401  (parquet files for the on-disk spreadsheet cache)
+    sheet_format = 'parquet'
+except ImportError:
+    sheet_format = 'pickle'
+
+
+class LRUCache:
+    """Thread safe dictionary keeping at most 'maxsize' most recently used items."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+
+#------------------------  Spreadsheets -----------------------------
+
+# parsed spreadsheets by (path, sheet): ((mtime, size), DataFrame)
+sheet_cache = LRUCache(cfg.sheet_cache_size)
+
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def read_sheet(path, sheet_name=0):
+    """pd.read_excel of a spreadsheet, parsed again only when the file changes.
+
+    Parsed sheets are kept in memory and, if sheet_cache_path is set, in a
+    parquet (or pickle) file that other processes and later runs reuse.
+    """
+    key = (os.path.abspath(path), sheet_name)
+    stamp = file_stamp(path)
+    cached = sheet_cache.get(key)
+    if cached is not None and cached[0] == stamp:
+        metrics.count('sheets', 'hit')
+        return cached[1].copy()
+
+    df = read_sheet_file(key, stamp)
+    if df is None:
+        metrics.count('sheets', 'miss')
+        df = pd.read_excel(path, sheet_name=sheet_name, engine='openpyxl')
+        write_sheet_file(key, stamp, df)
+    else:
+        metrics.count('sheets', 'hit')
+    sheet_cache.put(key, (stamp, df))
+    return df.copy()
+
+
+def read_sheets(paths, sheet_name=0):
+    """read_sheet of several files with a thread pool.
+
+    Returns a list in the order of 'paths' with the DataFrame, or the
+    exception raised while reading it.
+    """
+    def read(path):
+        try:
+            return read_sheet(path, sheet_name)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=cfg.sheet_workers) as pool:
+        return list(pool.map(read, paths))
+
+
+def sheet_file(key, stamp):
+    name = '{}.{}.{}_{}'.format(os.path.basename(key[0]), key[1], stamp[0], stamp[1])
+    return os.path.join(cfg.sheet_cache_path, name)
+
+
+def read_sheet_file(key, stamp):
+    if not cfg.sheet_cache_path:
+        return None
+    path = sheet_file(key, stamp)
+    try:
+        if os.path.exists(path+'.parquet'):
+            return pd.read_parquet(path+'.parquet')
+        if os.path.exists(path+'.pkl'):
+            return pd.read_pickle(path+'.pkl')
+    except Exception:
+        pass    # unreadable copy, parse the spreadsheet again
+    return None
+
+
+def write_sheet_file(key, stamp, df):
+    if not cfg.sheet_cache_path:
+        return
+    path = sheet_file(key, stamp)
+    try:
+        os.makedirs(cfg.sheet_cache_path, exist_ok=True)
+        # remove the copies of previous versions of the spreadsheet
+        for old in glob.glob(sheet_file(key, ('*', '*'))+'.*'):
+            os.remove(old)
+        if sheet_format == 'parquet':
+            try:
+                df.to_parquet(path+'.parquet')
+                return
+            except Exception:
+                pass    # e.g. columns of mixed types, which parquet does not store
+        df.to_pickle(path+'.pkl')
+    except OSError:
+        pass    # the cache is optional
+
+
+#------------------------  Query results -----------------------------
+
+# qplan_caller.Call results by query options and fingerprint of the source data,
+# on disk so that all the app processes (and background jobs) share them
+call_cache = diskcache.Cache(cfg.call_cache_path, size_limit=cfg.call_cache_size*2**20,
+                             eviction_policy='least-recently-used')
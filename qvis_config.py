@@ -40,7 +40,39 @@ schedpath_text = yaml_data['schedpath_text']
 
 # create database file in qvis_dash working directory
 current_semester = yaml_data['current_semester']
-database_path = os.path.join(yaml_data['database_path'],'database_'+current_semester+'.pickle')
+database_path = os.path.join(yaml_data['database_path'],'database_'+current_semester+'.sqlite3')
+
+# 'vector' (whole night at once with NumPy), 'adaptive' (coarse samples, then bisection
+# of the changes) or 'step' (5-min stepping with subaru.calc)
+visibility_method = yaml_data.get('visibility_method', 'vector')
+# minutes between the coarse samples and precision of the 'adaptive' method
+adaptive_coarse_step = int(yaml_data.get('adaptive_coarse_step', 30))
+adaptive_precision = int(yaml_data.get('adaptive_precision', 5))
+# number of processes computing nights in parallel, and max OBs per process task (0 = whole night)
+visibility_workers = int(yaml_data.get('visibility_workers', 1))
+visibility_chunk_size = int(yaml_data.get('visibility_chunk_size', 0))
+# number of (sky position, night) altitude/airmass tracks kept in memory; the queries
+# run in their own job processes, so they are shared within a query (or precompute run)
+track_cache_size = int(yaml_data.get('track_cache_size', 20000))
+
+# parsed spreadsheets kept in memory, directory of their parsed copies ('' for none)
+# and threads reading the program spreadsheets; the queries run in their own job
+# processes, so only the parsed copies are reused from one query to the next
+sheet_cache_size = int(yaml_data.get('sheet_cache_size', 500))
+sheet_cache_path = yaml_data.get('sheet_cache_path', './sheets')
+sheet_workers = int(yaml_data.get('sheet_workers', 8))
+
+# program/OB lookups in the queue database at once; each worker thread opens its
+# own queue database connection, so 1 (sequential, one connection) is the default
+qdb_workers = int(yaml_data.get('qdb_workers', 1))
+
+# stage timings and cache counters of all the app processes (see qvis_metrics)
+metrics_path = yaml_data.get('metrics_path', './metrics')
+
+# query results reused by identical queries: directory, max MB and seconds kept
+call_cache_path = yaml_data.get('call_cache_path', './queries')
+call_cache_size = int(yaml_data.get('call_cache_size', 512))
+call_cache_ttl = float(yaml_data.get('call_cache_ttl', 1800))
 
 
 #-------------------- App config ------------------------------
@@ -62,3 +94,23 @@ key_dic = {
 
 # options for max number of OBs/program in Query
 maxOBquery_arr = [10, 100, 300, 9999]
+
+# number of rendered figures kept in memory
+figure_cache_size = int(yaml_data.get('figure_cache_size', 32))
+
+# query results of each browser session: directory, idle seconds before removal, max sessions
+session_path = yaml_data.get('session_path', './sessions')
+session_ttl = float(yaml_data.get('session_ttl', 86400))
+session_max = int(yaml_data.get('session_max', 50))
+
+# background query jobs: cache directory, max seconds of a query, seconds its result
+# is kept for identical queries
+job_cache_path = yaml_data.get('job_cache_path', './jobs')
+job_timeout = float(yaml_data.get('job_timeout', 3600))
+job_result_ttl = float(yaml_data.get('job_result_ttl', 60))
+
+# rows per page of the OB tables, which are paged, sorted and filtered on the server
+table_page_size = int(yaml_data.get('table_page_size', 100))
+
+# OB-nights above which the timeline plots show the time band of each group per night
+max_timeline_rows = int(yaml_data.get('max_timeline_rows', 5000))
@@ -1,20 +1,30 @@
 from datetime import datetime, timedelta
+import uuid
 import dash
 from dash import dcc, html, callback_context
 import dash_bootstrap_components as dbc
+import flask
 from datetime import date
 from dash.dependencies import Input, Output, State
 from dash.exceptions import PreventUpdate
 
 import qvis_config as cfg
 import app_functions as fct
+import qvis_metrics
+from qvis_session import SessionStore
 
-app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
+# queries run as background jobs, in processes started by this manager
+background_manager = dash.DiskcacheManager(fct.job_cache)
+
+app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP],
+                background_callback_manager=background_manager,
+                # the OB table is created by a callback
+                suppress_callback_exceptions=True)
 server = app.server
 app.title = 'HSC QVis'
 
-app.pgms = []
-app.pgm_select = []
+# query results of each browser session, shared by the server processes
+sessions = SessionStore(cfg.session_path, cfg.session_ttl, cfg.session_max)
 
 checklist_grade = dcc.Checklist(
     id='grade-checklist',
@@ -90,9 +100,13 @@ tab1 = dbc.Card([
                     [
                         dbc.Button("Query OBs", id='button',
                                    color="primary", outline=True),
+                        dbc.Button("Cancel", id='cancel-button', disabled=True,
+                                   color="secondary", outline=True, size="sm"),
                     ],
                     className="d-grid gap-2 col-6 mx-auto",
-                )
+                ),
+                dbc.Progress(id='query-progress', value=0, label='', striped=True,
+                             className="mt-2")
                 ])
 ],style={'height':'15rem'}
 )
@@ -126,54 +140,60 @@ tab3 = dbc.Card([dbc.CardBody([
             ],style={'height':'15rem'}
             )           
 
-app.layout = html.Div([
-    html.Br(),
-    html.H1('HSC Queue Visualization', style={
-            'color': 'blue', 'textAlign': 'center'}),
-    dbc.Row([
-        dbc.Col([
-            dbc.Tabs(id='query-tabs',active_tab='1',
-                      children=[dbc.Tab(tab1, label='Query',tab_id='1'),
-                      dbc.Tab(tab2, label='Options',tab_id='2'),
-                      dbc.Tab(tab3, label='Summary',tab_id='3'),
-                      ])
-        ], width={'size': 6}),
-        dbc.Col([
-            html.Br(),
-            html.H5('Y-Axis'),
-            dcc.Dropdown(
-                id='y-axis',
-                options=[{'label': i, 'value': i}
-                         for i in cfg.available_yaxis],
-                value='OBs'
-            ),
-            html.H5('Group by'),
-            dcc.Dropdown(
-                id='groupby',
-                options=[{'label': i, 'value': cfg.key_dic[i]}
-                         for i in cfg.available_group],
-                value='program'
-            ),
-            html.H5('Filter Programs:'),
-            dcc.Dropdown(id='pgm-dropdown',
-                         options=app.pgms,
-                         value=app.pgm_select,
-                         multi=True
-                         ),
-        ], width={'size': 6}),
-    ], className="mx-5"),
-    dbc.Card([dbc.CardBody([html.P(id='log')])]),
-    html.Br(),
-    dcc.Loading([html.Div(id='chart')]),
-    html.Br(),
-    dbc.Tabs(id='table-tabs',active_tab='1',children=[
-                            dbc.Tab(label='Queried OBs',tab_id='1'),
-                            dbc.Tab(label='Observable OBs',tab_id='2'),
-                            dbc.Tab(label='Queue Schedule',tab_id='3')
-                            ]),
-    html.Div(id='datatable')
-]
-)
+def serve_layout():
+    # a new layout, with a new session id, for each page load
+    return html.Div([
+        dcc.Store(id='session-id', data=uuid.uuid4().hex),
+        dcc.Store(id='query-done'),
+        html.Br(),
+        html.H1('HSC Queue Visualization', style={
+                'color': 'blue', 'textAlign': 'center'}),
+        dbc.Row([
+            dbc.Col([
+                dbc.Tabs(id='query-tabs',active_tab='1',
+                          children=[dbc.Tab(tab1, label='Query',tab_id='1'),
+                          dbc.Tab(tab2, label='Options',tab_id='2'),
+                          dbc.Tab(tab3, label='Summary',tab_id='3'),
+                          ])
+            ], width={'size': 6}),
+            dbc.Col([
+                html.Br(),
+                html.H5('Y-Axis'),
+                dcc.Dropdown(
+                    id='y-axis',
+                    options=[{'label': i, 'value': i}
+                             for i in cfg.available_yaxis],
+                    value='OBs'
+                ),
+                html.H5('Group by'),
+                dcc.Dropdown(
+                    id='groupby',
+                    options=[{'label': i, 'value': cfg.key_dic[i]}
+                             for i in cfg.available_group],
+                    value='program'
+                ),
+                html.H5('Filter Programs:'),
+                dcc.Dropdown(id='pgm-dropdown',
+                             options=[],
+                             value=[],
+                             multi=True
+                             ),
+            ], width={'size': 6}),
+        ], className="mx-5"),
+        dbc.Card([dbc.CardBody([html.P(id='log')])]),
+        html.Br(),
+        dcc.Loading([html.Div(id='chart')]),
+        html.Br(),
+        dbc.Tabs(id='table-tabs',active_tab='1',children=[
+                                dbc.Tab(label='Queried OBs',tab_id='1'),
+                                dbc.Tab(label='Observable OBs',tab_id='2'),
+                                dbc.Tab(label='Queue Schedule',tab_id='3')
+                                ]),
+        html.Div(id='datatable')
+    ]
+    )
+
+app.layout = serve_layout
 
 @app.callback(
     Output('my-date-picker-single2','min_date_allowed'),
@@ -183,70 +203,96 @@ def limit_date_range(date_value):
     return date_value
 
 @app.callback(
-    Output('chart', 'children'),
-    Output('pgm-dropdown', 'options'),
-    Output('pgm-dropdown', 'value'),
-    Output('log','children'),
+    Output('query-done', 'data'),
     Input('button', 'n_clicks'),
-    Input('y-axis', 'value'),
-    Input('groupby', 'value'),
-    Input('pgm-dropdown', 'value'),
-    Input('time-window-only', 'value'),
-    Input('use-filter-schedule', 'value'),
     State('grade-checklist', 'value'),
     State('seeing-checklist', 'value'),
     State('transp-checklist', 'value'),
     State('filter-checklist', 'value'),
     State('my-date-picker-single', 'date'),
     State('my-date-picker-single2', 'date'),
-    State('maxOBs', 'value')
+    State('maxOBs', 'value'),
+    State('time-window-only', 'value'),
+    State('session-id', 'data'),
+    background=True,
+    running=[(Output('button', 'disabled'), True, False),
+             (Output('cancel-button', 'disabled'), False, True)],
+    cancel=[Input('cancel-button', 'n_clicks')],
+    progress=[Output('query-progress', 'value'), Output('query-progress', 'label')],
+    progress_default=[0, ''],
+    prevent_initial_call=True
 )
-def update(n_clicks, display, groupby, pgms, timewindow_obs, use_filter_schedule, grade, seeing, transp, filters, date_value, date_value2, maxOBquery):
+def query(set_progress, n_clicks, grade, seeing, transp, filters, date_value, date_value2, maxOBquery, timewindow_obs, session_id):
 
     sdate = datetime.strptime(date_value, '%Y-%m-%d')
     edate = datetime.strptime(date_value2, '%Y-%m-%d')
     timewindow_obs = True in timewindow_obs
-    use_filter_schedule = True in use_filter_schedule
     maxOBquery = cfg.maxOBquery_arr[maxOBquery]
 
-    if n_clicks is None:
+    state = fct.run_query(set_progress, grade, seeing, transp, filters, sdate, edate,
+                          maxOBquery, timewindow_obs, previous=sessions.get(session_id))
+    sessions.put(session_id, state)
+    set_progress((100, 'Done'))
+
+    # the query of the session changed, update() redraws
+    return state['plot_obj'].query_id
+
+@app.callback(
+    Output('chart', 'children'),
+    Output('pgm-dropdown', 'options'),
+    Output('pgm-dropdown', 'value'),
+    Output('log','children'),
+    Input('query-done', 'data'),
+    Input('y-axis', 'value'),
+    Input('groupby', 'value'),
+    Input('pgm-dropdown', 'value'),
+    Input('time-window-only', 'value'),
+    Input('use-filter-schedule', 'value'),
+    State('session-id', 'data')
+)
+def update(query_id, display, groupby, pgms, timewindow_obs, use_filter_schedule, session_id):
+
+    timewindow_obs = True in timewindow_obs
+    use_filter_schedule = True in use_filter_schedule
+
+    if query_id is None:
         raise PreventUpdate
 
-    # Execute only if callback triggered by Query button.
-    if callback_context.triggered_id == 'button':
-        app.call = fct.create_call(grade, seeing, transp, filters, sdate, edate,
-                               maxOBquery=maxOBquery,
-                               timewindow_obs=timewindow_obs
-                               )
-        app.db = fct.create_database(app.call)
-        app.plot_obj = fct.make_plot_obj(
-            app.call.df, app.call.sdate, app.call.edate, app.call.edate_user, app.db)
-        app.pgms = list(app.plot_obj.longdf.program.unique())
-        app.pgm_select = app.pgms.copy()
-
-    if callback_context.triggered_id == 'pgm-dropdown':
-        app.pgm_select = pgms
-    
-    app.plotly_fig = fct.make_fig(app.plot_obj, display, groupby,
-                              app.pgm_select, timewindow_obs, use_filter_schedule)
+    state = sessions.get(session_id)
+    if state is None:
+        return [], [], [], [html.P('== Session expired, please Query OBs again.')]
+
+    # the program selection is kept apart from the query results, which are not rewritten here
+    query_id = state['plot_obj'].query_id
+    pgm_select = sessions.get_selection(session_id, query_id)
+    if pgm_select is None:
+        pgm_select = state['pgm_select']
+    if callback_context.triggered_id == 'pgm-dropdown' and pgms != pgm_select:
+        pgm_select = pgms
+        sessions.put_selection(session_id, query_id, pgm_select)
 
-    app.log = fct.make_log(app.call,app.plot_obj)
+    timings = dict(state.get('timings', {}))
+    plotly_fig = fct.make_fig(state['plot_obj'], display, groupby,
+                              pgm_select, timewindow_obs, use_filter_schedule, timings)
 
+    log = fct.make_log(state['call'], state['plot_obj'], timings, state.get('windows'))
 
-    return app.plotly_fig,  app.pgms, app.pgm_select, app.log
+    return plotly_fig, state['pgms'], pgm_select, log
 
 @app.callback(
     Output('summary-tab','children'),
     Output ('query-tabs','active_tab'),
     Input('log','children'),
-    State('button','n_clicks')
+    State('button','n_clicks'),
+    State('session-id', 'data')
 )
-def summary_tab(log,n_clicks):
+def summary_tab(log,n_clicks,session_id):
 
-    if n_clicks is None:
+    state = sessions.get(session_id)
+    if n_clicks is None or state is None:
         raise PreventUpdate
 
-    content = fct.get_summary_info(app.call,app.plot_obj)
+    content = fct.get_summary_info(state['call'],state['plot_obj'])
     active_tab = '3'
 
     return content,active_tab
@@ -255,20 +301,43 @@ def summary_tab(log,n_clicks):
     Output('datatable','children'),
     Input('table-tabs','active_tab'),
     Input('log', 'children'),    
-    State('button','n_clicks')
+    State('button','n_clicks'),
+    State('session-id', 'data')
 )
-def update_table(active_tab,log,n_clicks):
+def update_table(active_tab,log,n_clicks,session_id):
 
-    if n_clicks is None:
+    state = sessions.get(session_id)
+    if n_clicks is None or state is None:
         raise PreventUpdate
-    if active_tab=='1':
-        app.table = fct.get_table(app.plot_obj.df)
-    elif active_tab=='2':
-        app.table = fct.get_table(app.plot_obj.df.loc[app.plot_obj.df.name.isin(app.plot_obj.longdf_user.name)])
-    elif active_tab=='3':
-        app.table = fct.get_table(app.plot_obj.queuenightschedule_df)
+    table = fct.get_table(fct.table_df(state['plot_obj'], active_tab), server_side=True)
         
-    return app.table
+    return table
+
+@app.callback(
+    Output('ob-table','data'),
+    Output('ob-table','tooltip_data'),
+    Output('ob-table','page_count'),
+    Input('ob-table','page_current'),
+    Input('ob-table','page_size'),
+    Input('ob-table','sort_by'),
+    Input('ob-table','filter_query'),
+    State('table-tabs','active_tab'),
+    State('session-id', 'data')
+)
+def update_table_page(page_current,page_size,sort_by,filter_query,active_tab,session_id):
+
+    # only the displayed page is sent to the browser
+    state = sessions.get(session_id)
+    if state is None:
+        raise PreventUpdate
+    df = fct.table_df(state['plot_obj'], active_tab)
+
+    return fct.table_page(df, page_current or 0, page_size, sort_by, filter_query)
+
+@server.route('/metrics')
+def metrics():
+    # stage timings and cache counters of all the app processes, for Prometheus
+    return flask.Response(qvis_metrics.prometheus_text(), mimetype='text/plain; version=0.0.4')
 
 if __name__=='__main__':
 
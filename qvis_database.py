@@ -1,46 +1,74 @@
+import os
 import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import time as timefunc
 from datetime import  timedelta
 from qplan.util.site import get_site
+from qplan.entity import StaticTarget
 import pytz
 local = pytz.timezone("US/Hawaii")
 subaru = get_site('subaru')
 
-import pickle
+import numpy as np
 import pandas as pd
 
 import qvis_config as cfg
+import qvis_visibility as vis
+from qvis_store import WindowStore, pickle_path
+from qvis_cache import read_sheet
 
 minute_delta = 5   # frequency of elevation data in minutes
 dark_moon_limit = 0.15   # maximum moon illumination fraction for 'dark' time
 gray_moon_limit = 0.77   # maximum moon illumination fraction for 'gray' time
+# night_window attributes holding the sun events, stored with each night in the database
+sun_events = ['sunset', 'evt12', 'evt18', 'mot12', 'mot18', 'next_sunrise', 'sunrise']
 
 class DataBase:
 
-    def __init__(self, call,logger):
+    def __init__(self, call,logger,progress=None):
 
         self.logger = logger
+        # called with (nights done, total nights) while computing the windows
+        self.progress = progress
         self.database_path = cfg.database_path
-        self.load_database()
         self.call = call
-        self.schedpath_text = cfg.schedpath_text
-        self.queuenightschedule_df = self.get_schedule_df()
         self.sdate = call.sdate
         self.edate = call.edate
+        self.load_database()
+        self.schedpath_text = cfg.schedpath_text
+        self.queuenightschedule_df = self.get_schedule_df()
         self.nightvis_info = self.get_windows()
+        self.windows_found, self.windows_computed = self.count_windows()
         self.save_database()
 
+    def get_nights(self):
+        nights = []
+        time = self.sdate
+        while time <= self.edate:
+            nights.append(time)
+            time = time + timedelta(days=1)
+        return nights
+
     def load_database(self):
+        # Only the nights of this query are read from the store
         try:
-            f = open(self.database_path, 'rb')
-            database = pickle.load(f)
-            f.close()
+            self.store = WindowStore(self.database_path, local)
+            old_path = pickle_path(self.database_path)
+            if len(self.store.stored_nights()) == 0 and os.path.exists(old_path):
+                self.logger.info("Importing database file {}".format(old_path))
+                self.store.import_pickle(old_path)
+            database = self.store.load(
+                [time.strftime("%y-%m-%d") for time in self.get_nights()])
         except Exception:
             self.logger.exception("Exception occurred")
             traceback.print_exc()
+            self.store = None
             database = {}
 
         self.database = database
+        # what is already on disk, so that only new data is written back
+        self.stored_keys = {date: set(entry['targ_dic']) for date, entry in database.items()}
+        self.stored_ephem = {date: entry.get('ephem') for date, entry in database.items()}
 
     def save_database(self):
 
@@ -49,24 +77,97 @@ class DataBase:
             # Transform night_window object to dictionary to get attributes only
             self.database[date] = self.nightvis_info[date].__dict__
 
-        with open(self.database_path, 'wb') as f:
-            pickle.dump(self.database, f)
+        if self.store is None:
+            return
+        try:
+            for date in self.nightvis_info.keys():
+                entry = self.database[date]
+                stored_keys = self.stored_keys.get(date, set())
+                new_keys = [key for key in entry['targ_dic'] if key not in stored_keys]
+                save_info = date not in self.stored_keys or entry['ephem'] is not self.stored_ephem[date]
+                if save_info or len(new_keys) > 0:
+                    self.store.save(date, entry, new_keys, save_info=save_info)
+        except Exception:
+            self.logger.exception("Exception occurred")
+            traceback.print_exc()
+        finally:
+            self.store.close()
+
+    def count_windows(self):
+        # windows of the query read from the database, and windows computed by this query
+        keys = set(window_keys(self.call.df, self.call.request_windows))
+        found = computed = 0
+        for date, nw in self.nightvis_info.items():
+            stored_keys = self.stored_keys.get(date, set())
+            found += len(keys & stored_keys)
+            computed += len(nw.targ_dic.keys() - stored_keys)
+        return found, computed
 
     def get_windows(self):
 
+        nights = self.get_nights()
+        if cfg.visibility_workers > 1:
+            self.fill_windows_parallel(nights)
+
         nightvis_info = {}
-        time = self.sdate
-        while time <= self.edate:
+        for k, time in enumerate(nights):
             nw = night_window(time, self.call.df, self.call.targets, self.call.request_windows,
                               self.queuenightschedule_df, self.database)
             nightvis_info[time.strftime("%y-%m-%d")] = nw
-            time = time + timedelta(days=1)
+            if self.progress is not None and cfg.visibility_workers <= 1:
+                self.progress(k+1, len(nights))
 
         return nightvis_info
 
+    def fill_windows_parallel(self, nights):
+        """Compute the windows missing from the database across a process pool.
+
+        Each night (split in chunks of OBs if visibility_chunk_size is set) is an
+        independent task; the results are merged into self.database so that
+        get_windows then only reads cached windows.
+        """
+        df, request_windows = self.call.df, self.call.request_windows
+        keys = window_keys(df, request_windows)
+        chunk_size = cfg.visibility_chunk_size
+
+        tasks = []
+        for time in nights:
+            night = self.database.get(time.strftime("%y-%m-%d"), {})
+            targ_dic = night.get('targ_dic', {})
+            new_rows = {}
+            for i, key in enumerate(keys):
+                if key not in targ_dic:
+                    new_rows.setdefault(key, i)
+            new_rows = list(new_rows.values())
+            if len(new_rows) == 0:
+                continue
+            # the night data without the windows (sun events and ephemeris)
+            info = {key: value for key, value in night.items() if key != 'targ_dic'}
+            step = chunk_size if chunk_size > 0 else len(new_rows)
+            for k in range(0, len(new_rows), step):
+                tasks.append((time, new_rows[k:k+step], info))
+
+        if len(tasks) == 0:
+            return
+        self.logger.info("Computing visibility windows in {} tasks with {} workers".format(
+            len(tasks), cfg.visibility_workers))
+
+        with ProcessPoolExecutor(max_workers=cfg.visibility_workers) as pool:
+            futures = [pool.submit(compute_windows, time, df.iloc[rows].reset_index(drop=True),
+                                   [request_windows[i] for i in rows], self.queuenightschedule_df, info)
+                       for time, rows, info in tasks]
+            for done, future in enumerate(as_completed(futures)):
+                nw = future.result()
+                if self.progress is not None:
+                    self.progress((done+1)*len(nights)//len(tasks), len(nights))
+                night = self.database.setdefault(nw.start.strftime("%y-%m-%d"), {})
+                night.setdefault('targ_dic', {}).update(nw.targ_dic)
+                night.update({key: value for key, value in nw.__dict__.items()
+                              if key not in ('targ_dic', 'targ_observable')})
+
     def get_schedule_df(self):
         try:
-            df = pd.read_excel(self.schedpath_text, engine='openpyxl')
+            df = read_sheet(self.schedpath_text)
         except Exception:
             self.logger.exception("Exception occurred")
             df = None
@@ -92,6 +193,35 @@ class DataBase:
 ############################################################################################################
 ##########################################################################################################
 
+def window_keys(df, request_windows):
+    """Keys of the OBs' visibility windows in the nightly 'targ_dic'.
+
+    A window only depends on the sky position and the observing constraints,
+    so OBs of different programs, or of targets with different names at the
+    same position, share one entry.
+    """
+    def bound(value):
+        return str(vis.bound_ns(value, local, ''))
+
+    # windows on a finer grid than the default are stored apart
+    suffix = ''
+    if cfg.visibility_method == 'adaptive' and cfg.adaptive_precision != minute_delta:
+        suffix = ',{}min'.format(cfg.adaptive_precision)
+
+    return ['{:.5f},{:+.5f},{:g},{:g},{},{:g},{},{}'.format(
+        vis.to_deg(ra, hours=True), vis.to_deg(dec), min_el, airmass, moon, moon_sep,
+        bound(window[0]), bound(window[1]))+suffix
+        for ra, dec, min_el, airmass, moon, moon_sep, window in zip(
+            df.target_ra, df.target_dec, df.telcfg_min_el, df.envcfg_airmass,
+            df.envcfg_moon, df.envcfg_moon_sep, request_windows)]
+
+
+def compute_windows(sdate, df, request_windows, queuenightschedule_df, night):
+    # process pool task: visibility windows of a chunk of OBs for one night
+    date = sdate.date().strftime("%y-%m-%d")
+    return night_window(sdate, df, None, request_windows, queuenightschedule_df, {date: night})
+
+
 class night_window:
     def __init__(self, sdate, df, targets, request_windows, queuenightschedule_df, database):
 
@@ -99,6 +229,49 @@ class night_window:
         start = sdate.strftime("%Y-%m-%d %H:%M")
         self.start = subaru.get_date(start)
         self.end = self.start+timedelta(days=1)
+
+        date = sdate.date().strftime("%y-%m-%d")
+        # Retrieves the data from database if it exists for this night.
+        night = database[date] if date in database else {}
+        self.targ_dic = night['targ_dic'] if 'targ_dic' in night else {}
+
+        if all(event in night for event in sun_events):
+            for event in sun_events:
+                setattr(self, event, night[event])
+        else:
+            self.get_sun_events()
+        if self.use_queue_schedule:
+            self.queue_night_limits = self.get_queue_night_limits(
+                queuenightschedule_df)
+        self.ephem = self.get_ephemeris(night.get('ephem'))
+
+        keys = window_keys(df, request_windows)
+        # first OB of each visibility window that is not in the database yet
+        new_rows = {}
+        for i, key in enumerate(keys):
+            if key not in self.targ_dic:
+                new_rows.setdefault(key, i)
+        new_rows = list(new_rows.values())
+
+        if len(new_rows) > 0:
+            if cfg.visibility_method == 'step':
+                for i in new_rows:
+                    target = targets[i] if targets is not None else StaticTarget(
+                        name=df.target_name[i], ra=df.target_ra[i], dec=df.target_dec[i])
+                    self.targ_dic[keys[i]] = self.step_window(
+                        target, df.telcfg_min_el[i], df.envcfg_airmass[i],
+                        df.envcfg_moon[i], df.envcfg_moon_sep[i], request_windows[i])
+            elif cfg.visibility_method == 'adaptive':
+                self.targ_dic.update(self.adaptive_windows(
+                    df, request_windows, keys, new_rows))
+            else:
+                self.targ_dic.update(self.vector_windows(
+                    df, request_windows, keys, new_rows))
+
+        self.targ_observable = [self.targ_dic[key]['window_start'] is not None
+                                for key in keys]
+
+    def get_sun_events(self):
         subaru.set_date(self.start)
         self.sunset = subaru.sunset()
         self.evt12 = subaru.evening_twilight_12()
@@ -109,99 +282,186 @@ class night_window:
         # a fix so that we get the sunrise of the same day, instead of next morning.
         subaru.set_date(self.start-timedelta(hours=12))
         self.sunrise = subaru.sunrise()
-        if self.use_queue_schedule:
-            self.queue_night_limits = self.get_queue_night_limits(
-                queuenightschedule_df)
 
-        date = sdate.date().strftime("%y-%m-%d")
-        # Retrieves the data from database if it exists for this night.
-        self.targ_dic = database[date]['targ_dic'] if date in database else {}
-        self.targ_observable = []
+    def get_ephemeris(self, ephem):
+        """Moon table on tonight's 5-min grid, shared by every target of the night."""
 
-        for i, target in enumerate(targets):
+        step_ns = minute_delta*vis.NS_PER_MINUTE
+        times_ns = np.arange(pd.Timestamp(self.night_limits()[0]).value,
+                             pd.Timestamp(self.end).value, step_ns, dtype=np.int64)
+        # reuse the stored table if it was computed on the same grid
+        if ephem is not None and np.array_equal(ephem['times_ns'], times_ns):
+            return ephem
+        return vis.night_ephemeris(times_ns)
 
-            observable = False
-            visible = False
-            SkyOk = False
-            if self.use_queue_schedule:
-                time = self.queue_night_limits[0]
-            else:
-                time = self.sunset
-            target_min_el = df.telcfg_min_el[i]
-            max_airmass = df.envcfg_airmass[i]
-            moon = df.envcfg_moon[i]
-            moon_sep = df.envcfg_moon_sep[i]
-            this_key = df.program[i]+df.target_name[i]+moon + \
-                str(moon_sep) + \
-                str(request_windows[i][0])+str(request_windows[i][1])
-            if not this_key in self.targ_dic:
-
-                self.targ_dic[this_key] = {}
-
-                while (time < self.end):
-
-                    info = subaru.calc(target, subaru.get_date(
-                        time.strftime("%Y-%m-%d %H:%M")))
-                    if not self.inside_time_window(time, request_windows[i]):
-                        time = time + timedelta(minutes=minute_delta)
-                        continue
-                    if not SkyOk:
-                        if self.sky_ok(info, moon_sep, moon):
-                            SkyOk = True
-                    if info.alt_deg >= target_min_el and info.airmass <= max_airmass and SkyOk and not visible:
-                        self.targ_dic[this_key]['window_start'] = time
-                        observable = True
-                        visible = True
-                    if info.airmass > max_airmass and visible:
-                        self.targ_dic[this_key]['window_end'] = time
-                        break
-                    if info.alt_deg < target_min_el and visible:
-                        self.targ_dic[this_key]['window_end'] = time
-                        break
-                    if time >= self.next_sunrise and visible:
-                        self.targ_dic[this_key]['window_end'] = time
-                        break
-                    if self.use_queue_schedule and visible:
-                        if time >= self.queue_night_limits[1]:
-                            self.targ_dic[this_key]['window_end'] = time
-                            break
-                    if time >= self.queue_night_limits[1] and not visible:
-                        break
-                    if time >= self.next_sunrise and not visible:
-                        break
-                    if SkyOk:
-                        if not self.sky_ok(info, moon_sep, moon):
-                            self.targ_dic[this_key]['window_end'] = time
-                            break
-                    time = time + timedelta(minutes=minute_delta)
-
-                if not observable:
-                    self.targ_dic[this_key]['window_start'] = None
-                    self.targ_dic[this_key]['window_end'] = None
-
-            elif not self.targ_dic[this_key]['window_start'] == None:
+    def night_limits(self):
+        # (first time, last time) a window may start/end at tonight
+        if self.use_queue_schedule:
+            return self.queue_night_limits
+        return (self.sunset, self.end)
+
+    def vector_windows(self, df, request_windows, keys, rows):
+        """Compute the visibility windows of the given OB rows for the whole night at once."""
+
+        windows = {keys[i]: {'window_start': None, 'window_end': None} for i in rows}
+        last = self.night_limits()[1]
+        times_ns = self.ephem['times_ns']
+        if len(times_ns) == 0:   # No Queue runs tonight
+            return windows
+        ra = [vis.to_deg(df.target_ra[i], hours=True) for i in rows]
+        dec = [vis.to_deg(df.target_dec[i]) for i in rows]
+        alt, am, sep = vis.position_tracks(self.ephem, ra, dec)
+        moon_alt, moon_pct = self.ephem['moon_alt'], self.ephem['moon_pct']
+
+        sky = vis.sky_ok([df.envcfg_moon[i] for i in rows], [df.envcfg_moon_sep[i] for i in rows],
+                         sep, moon_alt, moon_pct, dark_moon_limit, gray_moon_limit)
+        el_ok = (alt >= np.array([df.telcfg_min_el[i] for i in rows], dtype=float)[:, None]) & \
+            (am <= np.array([df.envcfg_airmass[i] for i in rows], dtype=float)[:, None])
+        inwin = vis.inside_time_windows([request_windows[i] for i in rows], times_ns, local)
+        stop_ns = min(pd.Timestamp(self.next_sunrise).value, pd.Timestamp(last).value)
+        stop = times_ns >= stop_ns
+
+        start, end = vis.find_windows(inwin, sky, el_ok, stop)
+        for k, i in enumerate(rows):
+            if start[k] < 0:
+                continue
+            windows[keys[i]]['window_start'] = self.grid_time(times_ns[start[k]])
+            windows[keys[i]]['window_end'] = self.grid_time(
+                times_ns[end[k]] if end[k] >= 0 else pd.Timestamp(self.end).value)
+        return windows
+
+    def adaptive_windows(self, df, request_windows, keys, rows):
+        """Visibility windows found by sampling the night coarsely and bisecting the changes.
+
+        Elevation/airmass and moon conditions are computed every
+        adaptive_coarse_step minutes (and at each target's transit), then only
+        around the times they change, down to adaptive_precision minutes.  The windows are then located like
+        in vector_windows, on the adaptive_precision grid.
+        """
+        windows = {keys[i]: {'window_start': None, 'window_end': None} for i in rows}
+        last = self.night_limits()[1]
+        if len(self.ephem['times_ns']) == 0:   # No Queue runs tonight
+            return windows
+        step_ns = cfg.adaptive_precision*vis.NS_PER_MINUTE
+        times_ns = np.arange(self.ephem['times_ns'][0], pd.Timestamp(self.end).value,
+                             step_ns, dtype=np.int64)
+        # positions are evaluated at the minute, like subaru.calc(get_date("%H:%M"))
+        calc_ns = times_ns - times_ns % vis.NS_PER_MINUTE
+        moon_alt, moon_pct, moon_ra, moon_dec = vis.moon_at(self.ephem, calc_ns)
+
+        jd = vis.jd_from_ns(calc_ns)
+        ra, dec = vis.precess(np.array([vis.to_deg(df.target_ra[i], hours=True) for i in rows]),
+                              np.array([vis.to_deg(df.target_dec[i]) for i in rows]), jd[len(jd)//2])
+        min_el = np.array([df.telcfg_min_el[i] for i in rows], dtype=float)
+        max_airmass = np.array([df.envcfg_airmass[i] for i in rows], dtype=float)
+        moon = np.array([df.envcfg_moon[i] for i in rows], dtype=object)
+        moon_sep = np.array([df.envcfg_moon_sep[i] for i in rows], dtype=float)
+
+        def el_ok(k, t):
+            alt = vis.altitude(ra[k], dec[k], calc_ns[t])
+            return (alt >= min_el[k]) & (vis.airmass(alt) <= max_airmass[k])
+
+        def sky_ok(k, t):
+            sep = vis.separation_deg(ra[k], dec[k], moon_ra[t], moon_dec[t])
+            return vis.sky_ok_at(moon[k], moon_sep[k], sep, moon_alt[t], moon_pct[t],
+                                 dark_moon_limit, gray_moon_limit)
+
+        coarse_step = max(1, cfg.adaptive_coarse_step//cfg.adaptive_precision)
+        # the elevation/airmass limits hold on one interval around the transit
+        el = vis.adaptive_mask(el_ok, len(rows), len(times_ns), coarse_step,
+                               vis.transit_index(ra, calc_ns))
+        sky = vis.adaptive_mask(sky_ok, len(rows), len(times_ns), coarse_step)
+        inwin = vis.inside_time_windows([request_windows[i] for i in rows], times_ns, local)
+        stop_ns = min(pd.Timestamp(self.next_sunrise).value, pd.Timestamp(last).value)
+        stop = times_ns >= stop_ns
+
+        start, end = vis.find_windows(inwin, sky, el, stop)
+        for k, i in enumerate(rows):
+            if start[k] < 0:
+                continue
+            windows[keys[i]]['window_start'] = self.grid_time(times_ns[start[k]])
+            windows[keys[i]]['window_end'] = self.grid_time(
+                times_ns[end[k]] if end[k] >= 0 else pd.Timestamp(self.end).value)
+        return windows
+
+    def grid_time(self, value_ns):
+        return pd.Timestamp(value_ns, tz='UTC').tz_convert(local)
+
+    def step_window(self, target, target_min_el, max_airmass, moon, moon_sep, request_window):
+        """Find the visibility window of one target by stepping through the night."""
+
+        window = {}
+        observable = False
+        visible = False
+        SkyOk = False
+        time = self.night_limits()[0]
+        k = -1   # index of time in the night ephemeris
+
+        while (time < self.end):
+
+            k += 1
+            info = subaru.calc(target, subaru.get_date(
+                time.strftime("%Y-%m-%d %H:%M")))
+            if not self.inside_time_window(time, request_window):
+                if visible:   # the requested time window closed
+                    window['window_end'] = time
+                    break
+                time = time + timedelta(minutes=minute_delta)
+                continue
+            if not SkyOk:
+                if self.sky_ok(k, info.moon_sep, moon_sep, moon):
+                    SkyOk = True
+            if info.alt_deg >= target_min_el and info.airmass <= max_airmass and SkyOk and not visible:
+                window['window_start'] = time
                 observable = True
-
-            self.targ_observable.append(observable)
-            # print("  ", self.start.strftime("%m-%d-%Y....."),
-            #       str(i+1).rjust(4), "OBs done", end='\r')
-
-    def sky_ok(self, info, moon_sep, moon):
-        if moon == 'dark' and self.dark_time(info, moon_sep):
+                visible = True
+            if info.airmass > max_airmass and visible:
+                window['window_end'] = time
+                break
+            if info.alt_deg < target_min_el and visible:
+                window['window_end'] = time
+                break
+            if time >= self.next_sunrise and visible:
+                window['window_end'] = time
+                break
+            if self.use_queue_schedule and visible:
+                if time >= self.queue_night_limits[1]:
+                    window['window_end'] = time
+                    break
+            if time >= self.night_limits()[1] and not visible:
+                break
+            if time >= self.next_sunrise and not visible:
+                break
+            if SkyOk:
+                if not self.sky_ok(k, info.moon_sep, moon_sep, moon):
+                    window['window_end'] = time
+                    break
+            time = time + timedelta(minutes=minute_delta)
+
+        if not observable:
+            window['window_start'] = None
+            window['window_end'] = None
+        elif 'window_end' not in window:   # still visible at the end of the night
+            window['window_end'] = self.end
+
+        return window
+
+    def sky_ok(self, k, sep, moon_sep, moon):
+        if moon == 'dark' and self.dark_time(k, sep, moon_sep):
             return True
-        if moon == 'gray' and (self.dark_time(info, moon_sep) or self.gray_time(info, moon_sep)):
+        if moon == 'gray' and (self.dark_time(k, sep, moon_sep) or self.gray_time(k, sep, moon_sep)):
             return True
         return False
 
-    def dark_time(self, info, moon_sep):
-        if info.moon_pct <= dark_moon_limit or info.moon_alt <= 0:
-            if info.moon_sep >= moon_sep:
+    def dark_time(self, k, sep, moon_sep):
+        if self.ephem['moon_pct'][k] <= dark_moon_limit or self.ephem['moon_alt'][k] <= 0:
+            if sep >= moon_sep:
                 return True
         return False
 
-    def gray_time(self, info, moon_sep):
-        if info.moon_pct <= gray_moon_limit and info.moon_alt > 0:
-            if info.moon_sep >= moon_sep:
+    def gray_time(self, k, sep, moon_sep):
+        if self.ephem['moon_pct'][k] <= gray_moon_limit and self.ephem['moon_alt'][k] > 0:
+            if sep >= moon_sep:
                 return True
         return False
 
@@ -0,0 +1,55 @@
+"""Timings of the query stages and cache counters, for the log panel and /metrics.
+
+The totals are kept in a diskcache shared by the app processes and the
+background query jobs, and are exported in the Prometheus text format.
+"""
+import time
+from contextlib import contextmanager
+
+import diskcache
+
+import qvis_config as cfg
+
+store = diskcache.Cache(cfg.metrics_path)
+
+
+@contextmanager
+def span(stage, timings=None):
+    """Time a stage: adds to its totals, and to timings[stage] if a dict is given."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - t0
+        store.incr(('stage_microseconds', stage), int(seconds*1e6))
+        store.incr(('stage_count', stage))
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+def count(cache, result, value=1):
+    """Count cache lookups, e.g. count('figures', 'hit')."""
+    if value > 0:
+        store.incr(('cache', cache, result), value)
+
+
+def prometheus_text():
+
+    stage_seconds, stage_count, cache = [], [], []
+    for key in sorted(store):
+        value = store.get(key, 0)
+        if key[0] == 'stage_microseconds':
+            stage_seconds.append('qvis_stage_seconds_total{{stage="{}"}} {:.6f}'.format(key[1], value/1e6))
+        elif key[0] == 'stage_count':
+            stage_count.append('qvis_stage_count_total{{stage="{}"}} {}'.format(key[1], value))
+        elif key[0] == 'cache':
+            cache.append('qvis_cache_lookups_total{{cache="{}",result="{}"}} {}'.format(
+                key[1], key[2], value))
+
+    lines = ['# HELP qvis_stage_seconds_total Time spent in each query stage.',
+             '# TYPE qvis_stage_seconds_total counter'] + stage_seconds
+    lines += ['# HELP qvis_stage_count_total Number of times each query stage ran.',
+              '# TYPE qvis_stage_count_total counter'] + stage_count
+    lines += ['# HELP qvis_cache_lookups_total Cache lookups by cache and result (hit or miss).',
+              '# TYPE qvis_cache_lookups_total counter'] + cache
+    return '\n'.join(lines) + '\n'
@@ -1,17 +1,31 @@
+import copy
+import uuid
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 from datetime import time as timefunc
 import plotly.express as px
 
+import qvis_config as cfg
+from qvis_database import window_keys, local
+
 # the visibility plots will ignore times after this hour in the morning
 morning_cut = timefunc(9, 0)
 # the visibility plots will ignore times before this hour in the evening
 evening_cut = timefunc(17, 54)
+# missing time in int64 nanoseconds
+NaT_ns = pd.NaT.value
+
+# columns of the OB DataFrame kept in longdf: hover data and the group-by options
+longdf_columns = ['name', 'program', 'grade', 'inscfg_filter', 'envcfg_seeing',
+                  'envcfg_transparency', 'envcfg_moon', 'target_name']
+longdf_columns += [column for column in cfg.key_dic.values() if column not in longdf_columns]
 
 class Plot:
     def __init__(self, df, start_date, end_date, end_date_user, db):
 
+        # identifies the query in the figure cache
+        self.query_id = uuid.uuid4().hex
         self.schedpath_text = db.schedpath_text
         self.df = df
         self.queuenightschedule_df = db.queuenightschedule_df
@@ -24,7 +38,9 @@ class Plot:
         self.request_windows = [(mindate, maxdate) for mindate, maxdate in zip(
             self.df.envcfg_lower_time_limit, self.df.envcfg_upper_time_limit)]
         self.load_windows(db.database)
+        self.day_shapes = self.get_day_shapes()
         self.longdf = self.get_longdf()
+        self.night_filters = self.get_night_filters()
 
         # Initialize the user input options
         self.longdf_user = self.longdf
@@ -32,6 +48,47 @@ class Plot:
         self.timewindow_obs = False
         self.use_filter_schedule = True
 
+    def __getstate__(self):
+        # the plots only need the sun events of the nights, not their windows and ephemeris
+        state = self.__dict__.copy()
+        state['nightvis_info'] = {night: {key: value for key, value in info.items()
+                                          if key not in ('targ_dic', 'targ_observable', 'ephem')}
+                                  for night, info in self.nightvis_info.items()}
+        return state
+
+    def subset(self, df, start_date, end_date, end_date_user):
+        """Plot of a narrower query: OBs of df (rows of self.df) in nights within this one's.
+
+        Reuses the visibility windows of self.longdf instead of reading the database.
+        """
+        plot = copy.copy(self)
+        plot.query_id = uuid.uuid4().hex
+        plot.df = df
+        plot.sdate = start_date
+        plot.edate = end_date
+        plot.edate_user = end_date_user
+        plot.nights_list = plot.get_nights_list()
+        plot.break_values = plot.get_break_values()
+        plot.request_windows = [(mindate, maxdate) for mindate, maxdate in zip(
+            df.envcfg_lower_time_limit, df.envcfg_upper_time_limit)]
+        time = plot.sdate
+        plot.nightvis_info = {}
+        while time <= plot.edate:
+            night = time.strftime("%y-%m-%d")
+            plot.nightvis_info[night] = self.nightvis_info[night]
+            time = time + timedelta(days=1)
+        plot.day_shapes = plot.get_day_shapes()
+
+        nights = (self.longdf.Date >= pd.Timestamp(plot.sdate.date())) & \
+            (self.longdf.Date <= pd.Timestamp(plot.edate_user.date()))
+        plot.longdf = self.longdf.loc[nights & self.longdf.ob_index.isin(df.index)]
+
+        plot.longdf_user = plot.longdf
+        plot.pgms_select = []
+        plot.timewindow_obs = False
+        plot.use_filter_schedule = True
+        return plot
+
     def get_nights_list(self):
         nights = pd.date_range(
             self.sdate.date(), self.edate_user.date(), freq='1D', tz=None)
@@ -61,45 +118,73 @@ class Plot:
                 "%y-%m-%d")] = database[time.strftime("%y-%m-%d")]
             time = time + timedelta(days=1)
 
-    def get_longdf(self):
+    def get_day_shapes(self):
+        """Gray rectangles from sunrise-30 min to sunset+30 min, added to the timelines at once."""
 
-        self.longdf = pd.DataFrame(columns=list(
-            self.df.columns.values)+['start', 'end'])
+        shapes = []
+        time = self.sdate
+        draw = True
+        while time <= self.edate:
+            if draw == True:
+                nw = self.nightvis_info[time.strftime("%y-%m-%d")]
+                shapes.append(dict(type='rect', xref='x', yref='y domain', y0=0, y1=1,
+                                   x0=nw['sunrise']-timedelta(minutes=30),
+                                   x1=nw['sunset']+timedelta(minutes=30),
+                                   line_width=0, fillcolor="gray"))
 
-        def this_key(i, program, this_df):
-            return program+this_df.target_name[i]+this_df.envcfg_moon[i]+str(this_df.envcfg_moon_sep[i])+str(self.request_windows[i][0])+str(self.request_windows[i][1])
+            # the day after a night out of the queue is hidden by the range breaks
+            draw = pd.Timestamp(time.date()) in self.nights_list
+            time = time + timedelta(days=1)
 
-        time = self.sdate
-        while time <= self.edate_user:
+        return shapes
 
-            tonight_df = self.df.copy()
-            tonight_df['start'], tonight_df['end'] = np.zeros(
-                tonight_df.shape[0]), np.zeros(tonight_df.shape[0])
+    def get_longdf(self):
 
-            nw = self.nightvis_info[time.strftime('%y-%m-%d')]
-            targ_dic = nw['targ_dic']
+        # visibility windows are looked up once per distinct key, then spread to the OBs
+        codes, keys = pd.factorize(pd.Series(window_keys(self.df, self.request_windows)))
+        queue_nights = set(self.nights_list)
 
-            # Only get visibility windows if night is within the queried period (case of schedule only)
-            if pd.Timestamp(time.date()) in self.nights_list:
+        def time_ns(value):
+            return NaT_ns if value is None or pd.isnull(value) else pd.Timestamp(value).value
 
-                start_list = [targ_dic[this_key(
-                    i, program, self.df)]['window_start'] for i, program in enumerate(self.df.program)]
-                end_list = [targ_dic[this_key(
-                    i, program, self.df)]['window_end'] for i, program in enumerate(self.df.program)]
-                tonight_df['start'] = start_list
-                tonight_df['end'] = end_list
+        rows, starts, ends = [], [], []
+        time = self.sdate
+        while time <= self.edate_user:
 
-                self.longdf = pd.concat(
-                    [self.longdf, tonight_df.copy()], axis=0, ignore_index=True)
+            # Only get visibility windows if night is within the queried period (case of schedule only)
+            if pd.Timestamp(time.date()) in queue_nights:
+
+                targ_dic = self.nightvis_info[time.strftime('%y-%m-%d')]['targ_dic']
+                start = np.array([time_ns(targ_dic[key]['window_start']) for key in keys],
+                                 dtype=np.int64)[codes]
+                end = np.array([time_ns(targ_dic[key]['window_end']) for key in keys],
+                               dtype=np.int64)[codes]
+                # keep the OBs that have an observable window tonight
+                observable = start != NaT_ns
+                rows.append(np.flatnonzero(observable))
+                starts.append(start[observable])
+                ends.append(end[observable])
 
             time = time + timedelta(days=1)
 
-        # remove rows of OBs that have no observable windows.
-        self.longdf = self.longdf.dropna(subset=['start'])
-
-        # Get the observing night. Subtract 1 day for OBs that start after midnight.
-        self.longdf['Date'] = pd.to_datetime(self.longdf.start.apply(lambda x: x.date(
-        )-timedelta(days=1) if x.time() < datetime(2000, 1, 1, 12, 0, 0).time() else x.date()))
+        def concat(arrays):
+            return np.concatenate(arrays) if len(arrays) > 0 else np.array([], dtype=np.int64)
+
+        rows = concat(rows)
+        # one row per OB and observable night, with only the columns used by the plots
+        df = self.df.iloc[rows]
+        self.longdf = pd.DataFrame({column: df[column].values for column in longdf_columns})
+        self.longdf.insert(0, 'ob_index', self.df.index.values[rows])
+        self.longdf['time_window'] = (df.envcfg_lower_time_limit.notna() |
+                                      df.envcfg_upper_time_limit.notna()).values
+        for column in ['name', 'target_name']:     # strings repeated every night
+            self.longdf[column] = self.longdf[column].astype('category')
+        self.longdf['start'] = pd.to_datetime(concat(starts), utc=True).tz_convert(local)
+        self.longdf['end'] = pd.to_datetime(concat(ends), utc=True).tz_convert(local)
+
+        # Get the observing night. Subtract 1 day for OBs that start before noon.
+        self.longdf['Date'] = (self.longdf.start.dt.tz_localize(None) -
+                               timedelta(hours=12)).dt.normalize()
 
         # Sort order of OBs to follow grade and program name in order.
         self.longdf.sort_values(
@@ -107,6 +192,27 @@ class Plot:
 
         return self.longdf
 
+    def memory_usage(self):
+        """Memory used by the OB DataFrame and the long DataFrames, in bytes."""
+        usage = {'df': self.df.memory_usage(deep=True).sum(),
+                 'longdf': self.longdf.memory_usage(deep=True).sum()}
+        if self.longdf_user is not self.longdf:
+            usage['longdf_user'] = self.longdf_user.memory_usage(deep=True).sum()
+        return usage
+
+    def get_night_filters(self):
+        """(night, filter) pairs available in the queue schedule, as a MultiIndex."""
+
+        if self.queuenightschedule_df is None:
+            return pd.MultiIndex.from_arrays([[], []], names=['obs_night', 'filter'])
+        # the filters of the first queue run are used for the whole night
+        schedule = self.queuenightschedule_df.drop_duplicates('obs_night', keep='first')
+        pairs = pd.DataFrame({'obs_night': schedule['obs_night'],
+                              'filter': schedule['filters'].str.split(',')})
+        pairs = pairs.explode('filter').dropna()
+        pairs['filter'] = pairs['filter'].str.lower().str.strip()    # make lower case
+        return pd.MultiIndex.from_frame(pairs)
+
     def update_longdf(self, pgms, timewindow_obs, use_filter_schedule):
 
         if pgms != self.pgms_select or use_filter_schedule != self.use_filter_schedule or timewindow_obs != self.timewindow_obs:
@@ -124,58 +230,57 @@ class Plot:
 
         if self.timewindow_obs == True:       # Filter OBs with time windows
 
-            longdf = longdf[~pd.isnull(longdf.envcfg_lower_time_limit) | ~pd.isnull(
-                longdf.envcfg_upper_time_limit)]
+            longdf = longdf[longdf.time_window]
 
         if self.use_filter_schedule == True:    # Filter OBs with available filters each night
 
-            schedule = self.queuenightschedule_df.copy(deep=True)
-            schedule['filters'] = schedule['filters'].str.split(',').apply(
-                lambda x: [val.lower().strip() for val in x])    # make lower case and turn into python list
+            idx = pd.MultiIndex.from_arrays(
+                [longdf['Date'], longdf['inscfg_filter']]).isin(self.night_filters)
+            longdf = longdf.loc[idx]
 
-            idx = longdf.apply(
-                lambda x: x['inscfg_filter'] in schedule.loc[schedule['obs_night'] == x['Date']]['filters'].iloc[0], axis=1)
-            if len(idx) > 0:
-                longdf = longdf.loc[idx]
-            else:
-                longdf = longdf.loc[[]]
+        # only the categories left in the selection make plot traces and legend entries
+        longdf = longdf.assign(**{column: longdf[column].cat.remove_unused_categories()
+                                  for column in longdf.columns
+                                  if isinstance(longdf[column].dtype, pd.CategoricalDtype)})
 
         self.longdf_user = longdf
 
+    def get_bands(self, longdf, columns):
+        """Time band covered each night by the OBs of each group, for large results.
+
+        One row per (group, night) from the earliest window start to the latest
+        window end, with the number of OBs, instead of one row per OB-night.
+        """
+        columns = list(dict.fromkeys(columns + ['Date']))
+        return longdf.groupby(columns, observed=True, sort=False).agg(
+            start=('start', 'min'), end=('end', 'max'), OBs=('ob_index', 'size')).reset_index()
+
     def fill_plot(self):
 
         longdf = self.longdf_user
+        aggregated = longdf.shape[0] > cfg.max_timeline_rows
+        if aggregated:
+            longdf = self.get_bands(longdf, [self.groupby])
+            y, hover_data = self.groupby, {'OBs': True}
+        else:
+            y, hover_data = "name", {'program': True, 'grade': True, 'inscfg_filter': True, 'envcfg_seeing': True,
+                                     'envcfg_transparency': True, 'envcfg_moon': True, 'target_name': True}
 
         minn = min(self.nights_list).date()
         maxx = max(self.nights_list).date()+timedelta(days=1)
 
         fig = px.timeline(longdf, x_start="start", x_end="end",
-                          y="name",
+                          y=y,
                           color=self.groupby,
                           template="simple_white",
-                          hover_data={'program': True, 'grade': True, 'inscfg_filter': True, 'envcfg_seeing': True,
-                                      'envcfg_transparency': True, 'envcfg_moon': True, 'target_name': True},
+                          hover_data=hover_data,
                           labels={'inscfg_filter': 'filter', 'envcfg_seeing': 'seeing',
                                   'envcfg_transparency': 'transp', 'envcfg_moon': 'moon', 'target_name': 'target'},
                           range_x=[datetime(minn.year, minn.month, minn.day, evening_cut.hour, evening_cut.minute),
                                    datetime(maxx.year, maxx.month, maxx.day, morning_cut.hour, morning_cut.minute)])
 
-        time = self.sdate
-        draw = True
-        while time <= self.edate:
-            if draw == True:
-                nw = self.nightvis_info[time.strftime("%y-%m-%d")]
-                # Draw the sunrise/sunset +-30 min limits
-                fig.add_vrect(x0=nw['sunrise']-timedelta(minutes=30), x1=nw['sunset'] +
-                              timedelta(minutes=30), line_width=0, fillcolor="gray")
-
-            if pd.Timestamp(time.date()) in self.nights_list:
-                draw = True
-            else:
-                draw = False
-
-            time = time + timedelta(days=1)
-            continue
+        # Draw the sunrise/sunset +-30 min limits
+        fig.update_layout(shapes=self.day_shapes)
 
         fig.update_xaxes(
             rangebreaks=[{'pattern': 'hour', 'bounds': [morning_cut.hour+morning_cut.minute/60., evening_cut.hour+evening_cut.minute/60.]},
@@ -188,36 +293,52 @@ class Plot:
 
         fig.add_annotation(x=0.01, y=1.03,
                            xref='paper', yref='paper',
-                           text="Queue Nights Only. Limits are 30 min after/before sunset/sunrise. ",
+                           text="Queue Nights Only. Limits are 30 min after/before sunset/sunrise. " +
+                           self.bands_note(aggregated),
                            showarrow=False,
                            )
 
         return fig
 
+    def bands_note(self, aggregated):
+        if not aggregated:
+            return ""
+        return "{} OB-nights: showing the time covered by the OBs of each group per night.".format(
+            self.longdf_user.shape[0])
+
+    def get_prog_offsets(self, longdf):
+        """Y value of each row in the program plot.
+
+        Programs are at 0, 1, 2... in order of appearance, and the groups of
+        each program are spread around it (max 0.35 away), in their order of
+        appearance in the program.  Returns the programs and the Y values.
+        """
+        prog_codes, pgms = pd.factorize(longdf['program'])
+        group_codes = pd.factorize(longdf[self.groupby], use_na_sentinel=False)[0]
+        # each (program, group) pair, numbered in order of appearance
+        ngroups_all = group_codes.max()+1 if len(group_codes) > 0 else 1
+        pair_codes, pairs = pd.factorize(prog_codes*ngroups_all + group_codes)
+        pair_pgm = pairs // ngroups_all
+        # rank of the group in its program, centered in zero and normalized
+        rank = pd.Series(pair_pgm).groupby(pair_pgm).cumcount().values
+        half = (np.bincount(pair_pgm, minlength=len(pgms))[pair_pgm]-1)/2.0
+        offsets = (rank-half)/np.maximum(1, half)*0.35
+        return pgms, prog_codes + offsets[pair_codes]
+
     def fill_plot_prog(self):
 
         longdf = self.longdf_user
+        aggregated = longdf.shape[0] > cfg.max_timeline_rows
+        if aggregated:
+            longdf = self.get_bands(longdf, ['program', self.groupby])
+            hover_data = {'Yval_offset': False, 'program': True, 'OBs': True}
+        else:
+            hover_data = {'Yval_offset': False, 'program': True, 'grade': True, 'inscfg_filter': True,
+                          'envcfg_seeing': True, 'envcfg_transparency': True, 'envcfg_moon': True, 'target_name': True}
 
-        pgms = longdf.program.unique()
-        # create mapping dict from program column
-        mapping_prog = {item: i for i, item in enumerate(pgms)}
-        # define the Y value using the program # of each OB
-        Yval = longdf['program'].apply(lambda x: mapping_prog[x])
-        Yval_offset = Yval
-        for pgm in pgms:
-            df = longdf.loc[longdf.program == pgm]
-            # create mapping dict from groupping column
-            mapping = {item: i for i, item in enumerate(
-                df[self.groupby].unique())}
-            # define an offset value using the group id number of each OB in this program
-            offsets = df[self.groupby].apply(lambda x: mapping[x])
-            # offset values have to center in zero
-            offsets = offsets-((len(mapping)-1)/2.0)
-            # offset values have to be normalized to maximum 0.3 deviation from axis tick
-            offsets = offsets/max(1, max(offsets))*0.35
-            # add the offsets accordingly to each OB based on their unique index of the original DataFrame.
-            Yval_offset = Yval_offset.add(offsets, fill_value=0)
-        longdf['Yval_offset'] = Yval_offset
+        pgms, Yval_offset = self.get_prog_offsets(longdf)
+        # a new frame: longdf_user is shared with the other plots
+        longdf = longdf.assign(Yval_offset=Yval_offset)
 
         minn = min(self.nights_list).date()
         maxx = max(self.nights_list).date()+timedelta(days=1)
@@ -228,25 +349,11 @@ class Plot:
                             template="simple_white",
                             range_x=[datetime(minn.year, minn.month, minn.day, evening_cut.hour, evening_cut.minute),
                                      datetime(maxx.year, maxx.month, maxx.day, morning_cut.hour, morning_cut.minute)],
-                            hover_data={'Yval_offset': False, 'program': True, 'grade': True, 'inscfg_filter': True,
-                                        'envcfg_seeing': True, 'envcfg_transparency': True, 'envcfg_moon': True, 'target_name': True},
+                            hover_data=hover_data,
                             labels={'inscfg_filter': 'filter', 'envcfg_seeing': 'seeing', 'envcfg_transparency': 'transp', 'envcfg_moon': 'moon', 'target_name': 'target'})
 
-        time = self.sdate
-        draw = True
-        while time <= self.edate:
-            if draw == True:
-                nw = self.nightvis_info[time.strftime("%y-%m-%d")]
-                fig.add_vrect(x0=nw['sunrise']-timedelta(minutes=30), x1=nw['sunset'] +
-                              timedelta(minutes=30), line_width=0, fillcolor="gray")
-
-            if pd.Timestamp(time.date()) in self.nights_list:
-                draw = True
-            else:
-                draw = False
-
-            time = time + timedelta(days=1)
-            continue
+        # Draw the sunrise/sunset +-30 min limits
+        fig.update_layout(shapes=self.day_shapes)
 
         fig.update_xaxes(
             rangebreaks=[{'pattern': 'hour', 'bounds': [morning_cut.hour+morning_cut.minute/60., evening_cut.hour+evening_cut.minute/60.]},
@@ -265,7 +372,8 @@ class Plot:
 
         fig.add_annotation(x=0.01, y=1.03,
                            xref='paper', yref='paper',
-                           text="Queue Nights Only. Limits are 30 min after/before sunset/sunrise.",
+                           text="Queue Nights Only. Limits are 30 min after/before sunset/sunrise. " +
+                           self.bands_note(aggregated),
                            showarrow=False,
                            )
 
@@ -275,7 +383,7 @@ class Plot:
 
         longdf = self.longdf_user
 
-        bardata = longdf.groupby(['Date', self.groupby]).count()['id']
+        bardata = longdf.groupby(['Date', self.groupby], observed=True).size()
 
         fig = px.bar(bardata.unstack())
 
@@ -305,7 +413,7 @@ class Plot:
 
         if self.groupby == 'inscfg_filter':
             grade_arr = df.grade.unique()
-            bardata = df.groupby([self.groupby, 'grade'])['total_time'].sum().div(
+            bardata = df.groupby([self.groupby, 'grade'], observed=True)['total_time'].sum().div(
                 3600).unstack('grade')[list(grade_arr)]
             fig = px.bar(bardata)
             fig.update_layout(yaxis_title="Total Combined Time (hours)")
@@ -316,7 +424,7 @@ class Plot:
             filter_arr = df.inscfg_filter.unique()
             # The df DataFrame has already been sorted by (grade,program).
             sorted_arr = df.program.unique()
-            bardata = df.groupby([self.groupby, 'inscfg_filter'])['total_time'].sum().div(
+            bardata = df.groupby([self.groupby, 'inscfg_filter'], observed=True)['total_time'].sum().div(
                 3600).unstack('inscfg_filter')[list(filter_arr)].loc[list(sorted_arr)]
             fig = px.bar(bardata)
             fig.update_layout(yaxis_title="Total Combined Time (hours)")
@@ -325,7 +433,7 @@ class Plot:
 
         else:
             filter_arr = df.inscfg_filter.unique()
-            bardata = df.groupby([self.groupby, 'inscfg_filter'])['total_time'].sum().div(
+            bardata = df.groupby([self.groupby, 'inscfg_filter'], observed=True)['total_time'].sum().div(
                 3600).unstack('inscfg_filter')[list(filter_arr)]
             fig = px.bar(bardata)
             fig.update_layout(yaxis_title="Total Combined Time (hours)")
@@ -338,7 +446,7 @@ class Plot:
         df.sort_values(by=['grade', 'program'], ascending=True, inplace=True)
 
         bardata = df.groupby(
-            ['program', 'grade'], as_index=False, sort=False)['completion_rate'].mean()
+            ['program', 'grade'], as_index=False, sort=False, observed=True)['completion_rate'].mean()
         bardata['perc_frac'] = bardata['completion_rate'].div(100)
 
         if horizontal:
@@ -0,0 +1,103 @@
+"""Fill the visibility database of a semester offline.
+
+Queries the queue database like the web app does and computes the
+visibility windows of every night in a date range, a few nights at a time.
+Each batch of nights is written to the database when it is done, so an
+interrupted run picks up where it stopped when started again.
+
+Example (run from the qvis_dash directory, where qvis_config.yaml is):
+
+    python qvis_precompute.py --from 2022-08-01 --until 2023-01-31 --workers 8
+"""
+import copy
+import sys
+import time as timer
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+
+from ginga.misc import log
+
+import qvis_config as cfg
+import qplan_caller
+import qvis_database
+
+
+def parse_args(args):
+
+    argprs = ArgumentParser(description='Precompute the HSC Queue Vis visibility database')
+    argprs.add_argument('--from', dest='sdate', required=True,
+                        help='first night (YYYY-MM-DD)')
+    argprs.add_argument('--until', dest='edate', required=True,
+                        help='last night (YYYY-MM-DD)')
+    argprs.add_argument('--grades', nargs='+', default=list(cfg.grade_dict.keys()),
+                        help='program grades (default: all)')
+    argprs.add_argument('--seeing', nargs='+', default=cfg.seeing_options,
+                        help='seeing values (default: all)')
+    argprs.add_argument('--transp', nargs='+', default=cfg.transp_options,
+                        help='transparency values (default: all)')
+    argprs.add_argument('--filters', nargs='+', default=list(cfg.filters_dict.keys()),
+                        help='filters (default: all)')
+    argprs.add_argument('--programs', nargs='+', default=None,
+                        help='only these proposals (default: all active programs)')
+    argprs.add_argument('--max-obs', dest='maxOBquery', type=int, default=max(cfg.maxOBquery_arr),
+                        help='max number of OBs per program')
+    argprs.add_argument('--workers', type=int, default=cfg.visibility_workers,
+                        help='processes computing nights in parallel')
+    argprs.add_argument('--batch', type=int, default=7,
+                        help='nights computed and saved together')
+    log.addlogopts(argprs)
+    return argprs.parse_args(args)
+
+
+def restrict_programs(call, programs):
+    # keep only the OBs of the given proposals
+    df = call.df.loc[call.df.program.isin(programs)].reset_index(drop=True)
+    keep = call.df.index[call.df.program.isin(programs)]
+    call.targets = [call.targets[i] for i in keep]
+    call.request_windows = [call.request_windows[i] for i in keep]
+    call.df = df
+    return call
+
+
+def main(args):
+
+    options = parse_args(args)
+    logger = log.get_logger(name='qvis_precompute', options=options)
+    cfg.visibility_workers = options.workers
+
+    sdate = datetime.strptime(options.sdate, '%Y-%m-%d')
+    edate = datetime.strptime(options.edate, '%Y-%m-%d')
+    logger.info("Querying the OBs")
+    call = qplan_caller.Call(options.grades, options.seeing, options.transp, options.filters,
+                             sdate, edate, options.maxOBquery, False, logger)
+    if not hasattr(call, 'df'):
+        logger.error("Query of the queue database failed")
+        return 1
+    if options.programs is not None:
+        call = restrict_programs(call, options.programs)
+    logger.info("{} OBs in {} programs".format(
+        call.df.shape[0], call.df.program.nunique()))
+
+    # nights are noon to noon, from call.sdate up to call.edate like in the web app
+    nights = []
+    time = call.sdate
+    while time <= call.edate:
+        nights.append(time)
+        time = time + timedelta(days=1)
+
+    t0 = timer.time()
+    for k in range(0, len(nights), options.batch):
+        batch = copy.copy(call)
+        batch.sdate, batch.edate = nights[k], nights[min(k+options.batch, len(nights))-1]
+        qvis_database.DataBase(batch, logger)
+        done = min(k+options.batch, len(nights))
+        elapsed = timer.time() - t0
+        logger.info("{}/{} nights done (up to {}), {:.0f} s elapsed, {:.0f} s left".format(
+            done, len(nights), batch.edate.strftime('%Y-%m-%d'), elapsed,
+            elapsed/done*(len(nights)-done)))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,99 @@
+import json
+import os
+import pickle
+import tempfile
+import time
+
+from qvis_cache import LRUCache
+
+
+class SessionStore:
+    """Query state of each browser session, shared by all the app processes.
+
+    The query results of a session (Call and Plot objects) are pickled in
+    one file per session id, so any worker process can serve the session's
+    callbacks, and each process keeps the states it used in memory until
+    their file is rewritten.  The program selection, changed by the display
+    callbacks, is a small JSON file next to it, so that changing it neither
+    rewrites the results nor overwrites a query that just finished.
+    Sessions not queried for 'ttl' seconds, and the oldest beyond 'maxsize'
+    sessions, are evicted.
+    """
+
+    def __init__(self, path, ttl, maxsize):
+        self.path = path
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.states = LRUCache(maxsize)
+        os.makedirs(path, exist_ok=True)
+
+    def file(self, sid, ext='.pickle'):
+        # session ids come from the browser, keep only safe characters
+        return os.path.join(self.path, ''.join(c for c in sid if c.isalnum())+ext)
+
+    def get(self, sid):
+        """Return the state of a session, or None if there is none (or it expired)."""
+
+        if not sid:
+            return None
+        try:
+            mtime = os.stat(self.file(sid)).st_mtime_ns
+        except OSError:
+            return None
+        cached = self.states.get(sid)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(self.file(sid), 'rb') as f:
+            state = pickle.load(f)
+        self.states.put(sid, (mtime, state))
+        return state
+
+    def put(self, sid, state):
+
+        self.write(self.file(sid), lambda f: pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL))
+        self.states.put(sid, (os.stat(self.file(sid)).st_mtime_ns, state))
+        self.evict()
+
+    def get_selection(self, sid, query_id):
+        """Return the program selection of a session's query, or None if it was not changed."""
+
+        try:
+            with open(self.file(sid, '.json')) as f:
+                selection = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if selection['query_id'] != query_id:
+            return None    # made for a previous query
+        return selection['pgm_select']
+
+    def put_selection(self, sid, query_id, pgm_select):
+
+        selection = {'query_id': query_id, 'pgm_select': pgm_select}
+        self.write(self.file(sid, '.json'), lambda f: json.dump(selection, f), mode='w')
+
+    def write(self, path, dump, mode='wb'):
+        # write a new file and rename it, so readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, mode) as f:
+            dump(f)
+        os.replace(tmp, path)
+
+    def evict(self):
+
+        files = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.pickle'):
+                continue
+            try:
+                files.append((os.stat(os.path.join(self.path, name)).st_mtime, name))
+            except OSError:
+                pass    # removed by another process
+        files.sort(reverse=True)
+        now = time.time()
+        for k, (mtime, name) in enumerate(files):
+            if k >= self.maxsize or now - mtime > self.ttl:
+                for path in [name, name[:-len('.pickle')]+'.json']:
+                    try:
+                        os.remove(os.path.join(self.path, path))
+                    except OSError:
+                        pass
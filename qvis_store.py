@@ -0,0 +1,102 @@
+import os
+import pickle
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+# night data that is not stored with the night (windows have their own table)
+skip_attrs = ('targ_dic', 'targ_observable')
+
+
+class WindowStore:
+    """Visibility database on disk, indexed by night and window key.
+
+    Each night's visibility windows are rows of the 'windows' table keyed by
+    (night, key), so a query only reads the nights it covers and only the
+    windows computed since the last query are written.  The other night data
+    (sun events, ephemeris, ...) is pickled in the 'nights' table.
+    """
+
+    def __init__(self, path, tz):
+        self.path = path
+        self.tz = tz
+        self.conn = sqlite3.connect(path, timeout=60)
+        # WAL lets several app processes read while one of them writes
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS nights (night TEXT PRIMARY KEY, info BLOB)')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS windows (night TEXT, key TEXT, window_start INTEGER, '
+            'window_end INTEGER, PRIMARY KEY (night, key)) WITHOUT ROWID')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def stored_nights(self):
+        return set(row[0] for row in self.conn.execute('SELECT night FROM nights'))
+
+    def load(self, nights):
+        """Return the database entries of the given nights ('%y-%m-%d') found in the store."""
+
+        database = {}
+        for night in nights:
+            row = self.conn.execute(
+                'SELECT info FROM nights WHERE night=?', (night,)).fetchone()
+            if row is None:
+                continue
+            entry = pickle.loads(row[0])
+            rows = self.conn.execute(
+                'SELECT key, window_start, window_end FROM windows WHERE night=?', (night,)).fetchall()
+            starts = self.to_times([r[1] for r in rows])
+            ends = self.to_times([r[2] for r in rows])
+            entry['targ_dic'] = {r[0]: {'window_start': start, 'window_end': end}
+                                 for r, start, end in zip(rows, starts, ends)}
+            database[night] = entry
+        return database
+
+    def save(self, night, entry, keys=None, save_info=True):
+        """Write a night's entry; only the windows in 'keys' (all if None) are written."""
+
+        if save_info:
+            info = {key: value for key, value in entry.items() if key not in skip_attrs}
+            self.conn.execute('INSERT OR REPLACE INTO nights VALUES (?, ?)',
+                              (night, pickle.dumps(info, protocol=pickle.HIGHEST_PROTOCOL)))
+        targ_dic = entry.get('targ_dic', {})
+        keys = list(targ_dic) if keys is None else list(keys)
+        if len(keys) > 0:
+            self.conn.executemany('INSERT OR REPLACE INTO windows VALUES (?, ?, ?, ?)',
+                                  [(night, key, self.to_ns(targ_dic[key].get('window_start')),
+                                    self.to_ns(targ_dic[key].get('window_end'))) for key in keys])
+        self.conn.commit()
+
+    def import_pickle(self, path):
+        """Copy the night data of a database pickle file of previous versions into the store.
+
+        Its windows are keyed by program and OB name, not by window_keys, so
+        they could never be found again and are not imported.
+        """
+
+        with open(path, 'rb') as f:
+            database = pickle.load(f)
+        for night, entry in database.items():
+            self.save(night, entry, keys=[])
+        return len(database)
+
+    def to_ns(self, value):
+        if value is None or pd.isnull(value):
+            return None
+        return int(pd.Timestamp(value).value)
+
+    def to_times(self, values):
+        # nanoseconds (or None) to timezone aware Timestamps (or None)
+        missing = [v is None for v in values]
+        ns = np.array([0 if v is None else v for v in values], dtype=np.int64)
+        times = pd.to_datetime(ns, utc=True).tz_convert(self.tz)
+        return [None if m else t for m, t in zip(missing, times)]
+
+
+def pickle_path(path):
+    # database file of previous versions, next to the store
+    return os.path.splitext(path)[0]+'.pickle'
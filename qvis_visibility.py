@@ -0,0 +1,298 @@
+import ephem
+import numpy as np
+import pandas as pd
+from qplan.util.site import get_site
+
+import qvis_config as cfg
+import qvis_metrics as metrics
+from qvis_cache import LRUCache
+
+subaru = get_site('subaru')
+# altitude, airmass and moon separation tracks by (night grid, RA, DEC).  Kept in the
+# process memory: the app runs each query in a new job process, so they are shared
+# by the OBs of one query (or of a precompute run), the windows being in the database.
+track_cache = LRUCache(cfg.track_cache_size)
+
+NS_PER_MINUTE = 60 * 10**9
+NS_PER_DAY = 86400 * 10**9
+JD_UNIX_EPOCH = 2440587.5   # Julian Date of 1970-01-01 00:00 UTC
+JD_J2000 = 2451545.0
+
+
+def _site_deg(site, deg_attr, attr):
+    # qplan observers keep the site coordinates either as degrees or as sexagesimal strings
+    value = getattr(site, deg_attr, None)
+    if value is not None:
+        return float(value)
+    return np.degrees(float(ephem.degrees(str(getattr(site, attr)))))
+
+
+site_lat_deg = _site_deg(subaru, 'lat_deg', 'latitude')
+site_lon_deg = _site_deg(subaru, 'lon_deg', 'longitude')
+site_elevation = float(getattr(subaru, 'elevation', 0.0) or 0.0)
+site_pressure = float(getattr(subaru, 'pressure', 0.0) or 0.0)
+site_temperature = float(getattr(subaru, 'temperature', 0.0) or 0.0)
+
+
+def to_deg(value, hours=False):
+    """Convert a RA/DEC value (degrees or sexagesimal string) to degrees."""
+    if isinstance(value, str) and ':' in value:
+        sign = -1.0 if value.strip().startswith('-') else 1.0
+        parts = [abs(float(part)) for part in value.strip().split(':')]
+        deg = sign*(parts[0] + parts[1]/60. + (parts[2] if len(parts) > 2 else 0.)/3600.)
+        return deg*15. if hours else deg
+    return float(value)
+
+
+def jd_from_ns(times_ns):
+    return np.asarray(times_ns, dtype=np.float64)/NS_PER_DAY + JD_UNIX_EPOCH
+
+
+def precess(ra_deg, dec_deg, jd):
+    """Precess J2000 mean coordinates to the mean equator of date (IAU 1976)."""
+    T = (jd - JD_J2000)/36525.
+    arcsec = np.pi/(180.*3600.)
+    zeta = (2306.2181*T + 0.30188*T**2 + 0.017998*T**3)*arcsec
+    z = (2306.2181*T + 1.09468*T**2 + 0.018203*T**3)*arcsec
+    theta = (2004.3109*T - 0.42665*T**2 - 0.041833*T**3)*arcsec
+    ra0, dec0 = np.radians(ra_deg), np.radians(dec_deg)
+    A = np.cos(dec0)*np.sin(ra0 + zeta)
+    B = np.cos(theta)*np.cos(dec0)*np.cos(ra0 + zeta) - np.sin(theta)*np.sin(dec0)
+    C = np.sin(theta)*np.cos(dec0)*np.cos(ra0 + zeta) + np.cos(theta)*np.sin(dec0)
+    ra = np.degrees(np.arctan2(A, B) + z) % 360.
+    dec = np.degrees(np.arcsin(np.clip(C, -1., 1.)))
+    return ra, dec
+
+
+def local_sidereal_deg(jd):
+    T = (jd - JD_J2000)/36525.
+    gmst = 280.46061837 + 360.98564736629*(jd - JD_J2000) + \
+        0.000387933*T**2 - T**3/38710000.
+    return (gmst + site_lon_deg) % 360.
+
+
+def refraction_deg(alt_deg):
+    """Bennett's refraction formula, scaled to the site pressure and temperature."""
+    h = np.maximum(alt_deg, -1.0)
+    R = 1.0/np.tan(np.radians(h + 7.31/(h + 4.4)))/60.
+    return R*(site_pressure/1010.)*(283./(273. + site_temperature))
+
+
+def airmass(alt_deg):
+    # Hardie (1962) airmass, undefined (infinite) below the horizon
+    with np.errstate(divide='ignore', invalid='ignore'):
+        secz = 1.0/np.sin(np.radians(alt_deg))
+        seczm1 = secz - 1.0
+        am = secz - 0.0018167*seczm1 - 0.002875*seczm1**2 - 0.0008083*seczm1**3
+    return np.where(alt_deg > 0, am, np.inf)
+
+
+def separation_deg(ra1, dec1, ra2, dec2):
+    ra1, dec1, ra2, dec2 = map(np.radians, (ra1, dec1, ra2, dec2))
+    hav = np.sin((dec2 - dec1)/2.)**2 + \
+        np.cos(dec1)*np.cos(dec2)*np.sin((ra2 - ra1)/2.)**2
+    return np.degrees(2.*np.arcsin(np.sqrt(np.clip(hav, 0., 1.))))
+
+
+def moon_track(times_ns):
+    """Moon altitude, illumination and apparent RA/DEC (deg) at each grid time."""
+    observer = ephem.Observer()
+    observer.lat = str(site_lat_deg)
+    observer.lon = str(site_lon_deg)
+    observer.elevation = site_elevation
+    observer.pressure = site_pressure
+    observer.temp = site_temperature
+    moon = ephem.Moon()
+
+    n = len(times_ns)
+    moon_alt, moon_pct = np.empty(n), np.empty(n)
+    moon_ra, moon_dec = np.empty(n), np.empty(n)
+    for k, jd in enumerate(jd_from_ns(times_ns)):
+        # ephem dates are Dublin Julian Days
+        observer.date = ephem.Date(jd - 2415020.0)
+        moon.compute(observer)
+        moon_alt[k] = np.degrees(moon.alt)
+        moon_pct[k] = moon.moon_phase
+        moon_ra[k] = np.degrees(moon.ra)
+        moon_dec[k] = np.degrees(moon.dec)
+    return moon_alt, moon_pct, moon_ra, moon_dec
+
+
+def night_ephemeris(times_ns):
+    """Moon table of one night, computed once per grid point and shared by all targets."""
+    times_ns = np.asarray(times_ns, dtype=np.int64)
+    moon_alt, moon_pct, moon_ra, moon_dec = moon_track(
+        times_ns - times_ns % NS_PER_MINUTE)
+    return {'times_ns': times_ns, 'moon_alt': moon_alt, 'moon_pct': moon_pct,
+            'moon_ra': moon_ra, 'moon_dec': moon_dec}
+
+
+def target_tracks(ra_deg, dec_deg, times_ns):
+    """Altitude (deg) and airmass of every target at every grid time.
+
+    Returns two arrays of shape (targets, times) plus the targets' RA/DEC
+    precessed to the night, for use in moon separations.
+    """
+    jd = jd_from_ns(times_ns)
+    ra, dec = precess(np.asarray(ra_deg, dtype=float),
+                      np.asarray(dec_deg, dtype=float), jd[len(jd)//2])
+    alt = altitude(ra[:, None], dec[:, None], np.asarray(times_ns)[None, :])
+    return alt, airmass(alt), ra, dec
+
+
+def altitude(ra_now, dec_now, times_ns):
+    """Apparent altitude (deg) of precessed RA/DEC at UTC ns times, broadcast together."""
+    ha = np.radians(local_sidereal_deg(jd_from_ns(times_ns)) - ra_now)
+    lat, dec_r = np.radians(site_lat_deg), np.radians(dec_now)
+    sin_alt = np.sin(lat)*np.sin(dec_r) + np.cos(lat)*np.cos(dec_r)*np.cos(ha)
+    alt = np.degrees(np.arcsin(np.clip(sin_alt, -1., 1.)))
+    return alt + refraction_deg(alt)
+
+
+def moon_at(ephem, times_ns):
+    """Moon altitude, illumination and RA/DEC at any times, interpolated in the night table."""
+    grid = ephem['times_ns']
+    ra = np.degrees(np.unwrap(np.radians(ephem['moon_ra'])))
+    return (np.interp(times_ns, grid, ephem['moon_alt']), np.interp(times_ns, grid, ephem['moon_pct']),
+            np.interp(times_ns, grid, ra) % 360., np.interp(times_ns, grid, ephem['moon_dec']))
+
+
+def position_tracks(ephem, ra_deg, dec_deg):
+    """Altitude, airmass and moon separation of sky positions on a night grid.
+
+    The tracks are cached by (night, RA, DEC): every OB at the same position
+    reuses them, whatever its program and constraints, and only the positions
+    not in the cache are computed.  Returns three (targets, times) arrays.
+    """
+    times_ns = ephem['times_ns']
+    grid = (int(times_ns[0]), len(times_ns))
+    keys = [grid + (round(ra, 5), round(dec, 5)) for ra, dec in zip(ra_deg, dec_deg)]
+    tracks = {key: track_cache.get(key) for key in keys}
+    missing = [key for key, track in tracks.items() if track is None]
+    metrics.count('tracks', 'hit', len(tracks) - len(missing))
+    metrics.count('tracks', 'miss', len(missing))
+    if len(missing) > 0:
+        # positions are evaluated at the minute, like subaru.calc(get_date("%H:%M"))
+        calc_ns = times_ns - times_ns % NS_PER_MINUTE
+        alt, am, ra_now, dec_now = target_tracks(
+            [key[2] for key in missing], [key[3] for key in missing], calc_ns)
+        sep = separation_deg(ra_now[:, None], dec_now[:, None],
+                             ephem['moon_ra'][None, :], ephem['moon_dec'][None, :])
+        for k, key in enumerate(missing):
+            tracks[key] = np.stack([alt[k], am[k], sep[k]]).astype(np.float32)
+            track_cache.put(key, tracks[key])
+    stacked = np.stack([tracks[key] for key in keys])
+    return stacked[:, 0], stacked[:, 1], stacked[:, 2]
+
+
+def sky_ok(moon, moon_sep, sep, moon_alt, moon_pct, dark_moon_limit, gray_moon_limit):
+    """Vectorized version of night_window.sky_ok over a (targets, times) grid."""
+    return sky_ok_at(np.asarray(moon, dtype=object)[:, None], np.asarray(moon_sep, dtype=float)[:, None],
+                     sep, moon_alt[None, :], moon_pct[None, :], dark_moon_limit, gray_moon_limit)
+
+
+def sky_ok_at(moon, moon_sep, sep, moon_alt, moon_pct, dark_moon_limit, gray_moon_limit):
+    # night_window.sky_ok on arrays broadcast together, one value per (target, time)
+    sep_ok = sep >= moon_sep
+    dark = ((moon_pct <= dark_moon_limit) | (moon_alt <= 0)) & sep_ok
+    gray = ((moon_pct <= gray_moon_limit) & (moon_alt > 0)) & sep_ok
+    return ((moon == 'dark') & dark) | ((moon == 'gray') & (dark | gray))
+
+
+def inside_time_windows(request_windows, times_ns, tz):
+    """Mask of grid times inside each OB's requested time window (inclusive)."""
+    lower = np.array([bound_ns(w[0], tz, np.iinfo(np.int64).min)
+                      for w in request_windows], dtype=np.int64)
+    upper = np.array([bound_ns(w[1], tz, np.iinfo(np.int64).max)
+                      for w in request_windows], dtype=np.int64)
+    times_ns = np.asarray(times_ns, dtype=np.int64)[None, :]
+    return (times_ns >= lower[:, None]) & (times_ns <= upper[:, None])
+
+
+def bound_ns(value, tz, default):
+    # time limit in UTC nanoseconds, naive times being local
+    if pd.isnull(value):
+        return default
+    value = pd.Timestamp(value)
+    if value.tzinfo is None:
+        value = value.tz_localize(tz)
+    return value.value
+
+
+def transit_index(ra_now, times_ns):
+    """Index of the grid time nearest to each target's meridian transit (highest altitude).
+
+    Next transit after the first grid time, clipped to the last one: the
+    altitude only rises until there and only sets after.
+    """
+    times_ns = np.asarray(times_ns, dtype=np.int64)
+    step_ns = times_ns[1] - times_ns[0] if len(times_ns) > 1 else 1
+    lst0 = local_sidereal_deg(jd_from_ns(times_ns[0]))
+    transit_ns = (np.asarray(ra_now) - lst0) % 360./360.98564736629*NS_PER_DAY
+    before = np.clip((transit_ns//step_ns).astype(np.int64), 0, len(times_ns) - 1)
+    after = np.minimum(before + 1, len(times_ns) - 1)
+
+    def hour_angle(idx):
+        return np.abs((local_sidereal_deg(jd_from_ns(times_ns[idx])) - ra_now + 180.) % 360. - 180.)
+    return np.where(hour_angle(after) < hour_angle(before), after, before)
+
+
+def adaptive_mask(evaluate, n_targets, n_times, coarse_step, samples=None):
+    """(targets, times) boolean grid of a condition, from coarse samples and bisections.
+
+    evaluate(targets, times) returns the condition at arrays of target and
+    grid time indices (broadcast together).  It is sampled every coarse_step
+    grid times, plus at samples[target] if given, then each interval between
+    samples where it changes is bisected down to the grid time where it
+    changes, assuming it changes once in there.
+    """
+    coarse = np.unique(np.r_[np.arange(0, n_times, coarse_step), n_times - 1])
+    coarse = np.broadcast_to(coarse, (n_targets, len(coarse)))
+    if samples is not None:
+        coarse = np.sort(np.c_[coarse, samples], axis=1)
+    values = evaluate(np.arange(n_targets)[:, None], coarse)
+    target, interval = np.nonzero(values[:, 1:] != values[:, :-1])
+    lo, hi = coarse[target, interval], coarse[target, interval + 1]
+    before = values[target, interval]
+    todo = np.flatnonzero(hi - lo > 1)
+    while len(todo) > 0:
+        mid = (lo[todo] + hi[todo])//2
+        same = evaluate(target[todo], mid) == before[todo]
+        lo[todo] = np.where(same, mid, lo[todo])
+        hi[todo] = np.where(same, hi[todo], mid)
+        todo = todo[hi[todo] - lo[todo] > 1]
+
+    # the condition flips at each 'hi', starting from its value at the first grid time
+    flips = np.zeros((n_targets, n_times), dtype=np.int8)
+    flips[:, 0] = values[:, 0]
+    flips[target, hi] = np.where(before, -1, 1)
+    return np.cumsum(flips, axis=1, dtype=np.int8) > 0
+
+
+def _first_true(mask):
+    idx = mask.argmax(axis=1)
+    idx[~mask.any(axis=1)] = -1
+    return idx
+
+
+def find_windows(inwin, sky, el_ok, stop):
+    """Locate the first observing window of each target from boolean grids.
+
+    Mirrors the stepping logic of night_window: the sky condition latches at
+    its first good sample inside the request window, the window opens at the
+    first sample where the elevation/airmass limits also hold, and it closes
+    at the first later sample where any condition fails or the night limit
+    (sunrise or end of the queue run) is reached.  Returns the start and end
+    indices into the time grid, -1 where there is no window (or no end).
+    """
+    latched = np.logical_or.accumulate(inwin & sky, axis=1)
+    opens = inwin & latched & el_ok
+    aborts = inwin & (stop[None, :] | (latched & ~sky))
+    first = _first_true(opens | aborts)
+    rows = np.arange(len(first))
+    start = np.where((first >= 0) & opens[rows, np.maximum(first, 0)], first, -1)
+
+    closes = ~inwin | ~el_ok | ~sky | stop[None, :]
+    closes &= np.arange(inwin.shape[1])[None, :] >= start[:, None]
+    end = np.where(start >= 0, _first_true(closes), -1)
+    return start, end